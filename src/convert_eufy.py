@@ -1,11 +1,9 @@
 #!/usr/bin/python3
-import csv
 import os
 import re
 import sys
 import datetime
-from collections import defaultdict
-from dataclasses import dataclass
+from typing import Iterable, Iterator
 
 import click
 import rich.emoji
@@ -13,7 +11,18 @@ from rich.console import Console
 from rich.table import Table
 from rich.style import Style
 from getkey import getkey, keys
-from fit import FitEncoderWeight
+import pipeline
+from metrics import METRICS
+import profiles
+from entries import WeightEntry
+from eufyformatter import STDIN, ConversionError, is_plain_file, iter_source_entries, read_entries_sharded
+from quarantine import Quarantine
+from sorting import DEFAULT_MEMORY_BUDGET, sort_entries
+from summary import Summary, period_label
+import filters
+from filters import OutlierFilter
+from fit import FitError
+from sinks import FitSink, Sink, create_sink, write_sinks
 
 EUFY_COLUMN_CONVERSIONS = {
   "Time": "Date",
@@ -46,30 +55,6 @@ EUFY_COLUMN_CONVERSIONS = {
 }
 
 
-@dataclass
-class WeightEntry:
-  time: datetime.datetime
-  weight: float  # weight in kg
-  bmi: float
-  body_fat: float = 0  # % of body weight due to fat
-  heart_rate: float = 0
-  muscle_mass: float = 0  # muscle mass in body in kg
-  muscle_mass_percent: float = 0  # % of body weight due to muscle
-  bmr: float = 0
-  water: float = 0  # mass of water in body in kg
-  body_fat_mass: float = 0  # fat in body in kg
-  lean_body_mass: float = 0  # lean body mass in kg
-  bone_mass: float = 0  # mass of bones in kg
-  bone_mass_percentage: float = 0  # % of body weight due to bones
-  visceral_fat_percentage: float = 0  # visceral fat percentagge
-  protein_percentage: float = 0  # % of protein in body
-  skeletal_muscle_mass: float = 0  # mass of skeletal muscle in kg
-  subcutaneous_fat_percentage: float = 0  # % of subcutaneous fat
-  body_age: float = 0  # estimated body age
-  body_type: str = ""  # body type categorization
-  head_size: float = 0  # size of head in cm
-
-
 def convert_fieldname(fieldname: str) -> str:
   """
   Convert fieldname to data class field name
@@ -133,160 +118,202 @@ def convert_fieldname(fieldname: str) -> str:
     case "HEAD SIZE (cm)":
       return "head_size"
     case _:
+      if (field := profiles.lookup_field(fieldname)) is not None:
+        return field
       sys.exit(f"Unrecognized field {fieldname}, exiting\n")
   return ""
 
 
-def read_eufyfile(filename: str = None) -> list[WeightEntry]:
+def read_eufyfile(filename: str = None, workers: int = 1, on_error: str = "exit",
+                  quarantine: Quarantine = None, pipelined: bool = False) -> list[WeightEntry]:
   """
-  Parse an exported eufy file and return a list with entries
-
-  :param filename: string with name of file to read
+  Parse an exported eufy file and return a list with entries, the source
+  profile used to decode rows is selected from the header of the file
+
+  :param filename: string with name of file to read, .gz, .bz2 and .zip files are decompressed, - reads stdin
+  :param workers: number of processes used to parse large files
+  :param on_error: exit on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :param pipelined: read and parse the file on a background thread
   :return: list of WeightEntry objects
   """
   if filename is None:
     sys.exit("Filename not specified, exiting\n")
-  if not os.path.exists(filename) or not os.path.isfile(filename):
+  if filename != STDIN and not os.path.isfile(filename):
+    sys.exit("File does not exist or is invalid, exiting\n")
+
+  if workers > 1 and is_plain_file(filename):
+    try:
+      entries = read_entries_sharded(filename, workers, on_error, quarantine)
+    except ConversionError as e:
+      sys.exit(f"{e}, exiting\n")
+    METRICS.count("rows_read", len(entries))
+    return entries
+
+  entries = iter_eufyfile(filename, on_error, quarantine)
+  return list(pipeline.threaded(entries) if pipelined else entries)
+
+
+def iter_eufyfile(filename: str, on_error: str = "exit", quarantine: Quarantine = None) -> Iterator[WeightEntry]:
+  """
+  Parse an exported eufy file one row at a time
+
+  :param filename: string with name of file to read, .gz, .bz2 and .zip files are decompressed, - reads stdin
+  :param on_error: exit on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :return: iterator over WeightEntry objects
+  """
+  if filename != STDIN and not os.path.isfile(filename):
     sys.exit("File does not exist or is invalid, exiting\n")
+  rows = 0
+  try:
+    for entry in iter_source_entries(filename, on_error, quarantine):
+      rows += 1
+      yield entry
+  except ConversionError as e:
+    sys.exit(f"{e}, exiting\n")
+  finally:
+    METRICS.count("rows_read", rows)
+
+
+def load_profiles(profile_files: tuple[str, ...]) -> None:
+  """
+  Load and register source profiles from json files
 
-  entries = []
-  lb_to_kg_factor = 0.45359237
-  with open(filename, "r", encoding='utf-8-sig') as eufy_file:
-    reader = csv.DictReader(eufy_file)
-    for row in reader:
-      entry = WeightEntry(datetime.datetime.now(), 0.0, 0.0)
-      for key, val in row.items():
-        match key:
-          case "Time":
-            entry.time = datetime.datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
-          case "Family Members":
-            pass
-          case "WEIGHT (kg)":
-            entry.weight = float(val)
-          case "WEIGHT (lbs)":
-            entry.weight = round(float(val) * lb_to_kg_factor, 1)  # convert to kg
-          case "BMI":
-            entry.bmi = float(val)
-          case "BODY FAT %":
-            entry.body_fat = float(val)
-          case "HEART RATE (bpm)":
-            entry.heart_rate = float(val)
-          case "MUSCLE MASS (kg)":
-            entry.muscle_mass = float(val)
-          case "MUSCLE MASS (lbs)":
-            entry.muscle_mass = round(float(val) * lb_to_kg_factor, 1)
-          case "MUSCLE MASS %":
-            entry.muscle_mass_percent = float(val)
-          case "BMR":
-            entry.bmr = float(val)
-          case "WATER":
-            entry.water = float(val)
-          case "BODY FAT MASS (kg)":
-            entry.body_fat_mass = float(val)
-          case "BODY FAT MASS (lbs)":
-            entry.body_fat_mass = round(float(val) * lb_to_kg_factor, 1)
-          case "LEAN BODY MASS (kg)":
-            entry.lean_body_mass = float(val)
-          case "LEAN BODY MASS (lbs)":
-            entry.lean_body_mass = round(float(val) * lb_to_kg_factor, 1)
-          case "BONE MASS (kg)":
-            entry.bone_mass = float(val)
-          case "BONE MASS (lbs)":
-            entry.bone_mass = round(float(val) * lb_to_kg_factor, 1)
-          case "BONE MASS %":
-            entry.bone_mass_percentage = float(val)
-          case "VISCERAL FAT":
-            entry.visceral_fat_percentage = float(val)
-          case "PROTEIN %":
-            entry.protein_percentage = float(val)
-          case "SKELETAL MUSCLE MASS (kg)":
-            entry.skeletal_muscle_mass = float(val)
-          case "SKELETAL MUSCLE MASS (lbs)":
-            entry.skeletal_muscle_mass = round(float(val) * lb_to_kg_factor, 1)
-          case "SUBCUTANEOUS FAT %":
-            entry.subcutaneous_fat_percentage = float(val)
-          case "BODY AGE":
-            entry.body_age = float(val)
-          case "BODY TYPE":
-            entry.body_type = str(val)
-          case "HEAD SIZE (cm)":
-            entry.head_size = float(val)
-          case _:
-            sys.exit(f"Unrecognized field {key}, exiting\n")
-      entries.append(entry)
-  return entries
-
-
-def write_garmin_file(filename: str, entries: list[WeightEntry], fields: list[str] = None) -> None:
-  """
-  Write a csv file for import to garmin
+  :param profile_files: names of json files with profiles
+  :return: None
+  """
+  for profile_file in profile_files:
+    if not os.path.isfile(profile_file):
+      sys.exit(f"Profile {profile_file} does not exist, exiting\n")
+    try:
+      profiles.register_profile(profiles.load_profile(profile_file))
+    except (ValueError, KeyError, AttributeError) as e:
+      sys.exit(f"Invalid profile {profile_file}: {e}, exiting\n")
+
+
+def filter_dates(entries: Iterable[WeightEntry], start_time: datetime.datetime,
+                 end_time: datetime.datetime) -> Iterator[WeightEntry]:
+  """
+  Keep entries in a time range, counting the entries that are left out
+
+  :param entries: iterable of WeightEntry objects
+  :param start_time: first time to include
+  :param end_time: last time to include
+  :return: iterator over entries in the range
+  """
+  filtered = 0
+  try:
+    for entry in entries:
+      if start_time <= entry.time <= end_time:
+        yield entry
+      else:
+        filtered += 1
+  finally:
+    METRICS.count("rows_filtered", filtered)
+
+
+def parse_date_range(start: str = None, end: str = None) -> tuple[datetime.datetime, datetime.datetime]:
+  """
+  Parse the start and end dates of the range to export
+
+  :param start: start date in YYYY-MM-DD format, None for 2000-01-01
+  :param end: end date in YYYY-MM-DD format, None for now
+  :return: tuple with the start of the first day and the end of the last day
+  """
+  date_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+  if start is None:
+    start_time = datetime.datetime(2000,
+                                   1,
+                                   1, 0, 0, 0)
+  else:
+    if match := date_re.match(start):
+      start_time = datetime.datetime(int(match.group(1)),
+                                     int(match.group(2)),
+                                     int(match.group(3)), 0, 0, 0)
+    else:
+      sys.exit("Start date must be in YYYY-MM-DD format, exiting\n")
+
+  if end is None:
+    end_time = datetime.datetime.now()
+  else:
+    if match := date_re.match(end):
+      end_time = datetime.datetime(int(match.group(1)),
+                                   int(match.group(2)),
+                                   int(match.group(3)), 23, 59, 59)
+    else:
+      sys.exit("End date must be in YYYY-MM-DD format, exiting\n")
+  return start_time, end_time
+
+
+def write_garmin_file(filename: str, entries: Iterable[WeightEntry], fields: list[str] = None,
+                      sinks: list[Sink] = None, compressed_timestamps: bool = False,
+                      verify: bool = False, append: bool = False, pipelined: bool = False) -> None:
+  """
+  Write a fit file for import to garmin
 
   :param filename: filename to write
-  :param entries: list of WeightEntry objects
-  :param fields:  list of fields from entries to export
+  :param entries: iterable of WeightEntry objects
+  :param fields:  list of columns or WeightEntry fields to export
+  :param sinks: additional sinks that receive the same entries
+  :param compressed_timestamps: use compressed timestamp headers for records close together in time
+  :param verify: decode the written file and check it against the entries
+  :param append: add entries newer than the last reading of an existing file instead of exiting
+  :param pipelined: encode and write entries on a background thread
   :return: None
   """
-  if os.path.exists(filename):
+  if os.path.exists(filename) and not append:
     sys.exit("File already exists, exiting\n")
-  selected_fields = ["time", "weight", "bmi", "body_fat", "muscle_mass", "bmr", "water", "bone_mass"]
+  selected_fields = None
   if fields is not None:
-    selected_fields = [convert_fieldname(x) for x in fields]
-
-  encoder = FitEncoderWeight()
-  encoder.write_file_info()
-  encoder.write_file_creator()
+    selected_fields = [x if x in WeightEntry.__dataclass_fields__ else convert_fieldname(x) for x in fields]
+  fit_sink = FitSink(filename, selected_fields, compressed_timestamps=compressed_timestamps, verify=verify,
+                     append=append)
+  try:
+    with METRICS.stage("write"):
+      if pipelined:
+        pipeline.write_sinks_threaded(entries, [fit_sink] + (sinks or []))
+      else:
+        write_sinks(entries, [fit_sink] + (sinks or []))
+  except FitError as e:
+    if append:
+      sys.exit(f"Cannot append to {filename}: {e}, exiting\n")
+    sys.exit(f"Cannot write {filename}: {e}, exiting\n")
+  METRICS.count("records_encoded", fit_sink.count)
+  METRICS.count("output_bytes", fit_sink.size)
+  if append:
+    click.echo(f"Appended {fit_sink.count} records to {filename}, {fit_sink.skipped} were already present")
+  if verify:
+    try:
+      records = fit_sink.verify()
+    except FitError as e:
+      sys.exit(f"Verification of {filename} failed: {e}, exiting\n")
+    click.echo(f"Verified {records} records in {filename}")
+
+
+def parse_sink(spec: str) -> Sink:
+  """
+  Create a sink from a FILE[:FIELD,FIELD...] specification, the format is
+  selected from the file extension
 
-  with open(filename, "wb") as f:
-    for entry in entries:
-      fields = defaultdict(float)
-      for field in selected_fields:
-        match field:
-          case "weight":
-            fields["weight"] = entry.weight
-          case "bmi":
-            fields["bmi"] = entry.bmi
-          case "body_fat":
-            fields["body_fat"] = entry.body_fat
-          case "muscle_mass":
-            fields["muscle_mass"] = entry.muscle_mass
-          case "bmr":
-            fields["bmr"] = entry.bmr
-          case "water":
-            fields["water"] = entry.water
-          case "bone_mass":
-            fields["bone_mass"] = entry.bone_mass
-          case "body_age":
-            fields["body_age"] = entry.body_age
-          case "visceral_fat_percentage":
-            fields["visceral_fat_mass"] = entry.visceral_fat_percentage
-          case ("family_member" |
-                "heart_rate" |
-                "muscle_mass_percent" |
-                "body_fat_mass" |
-                "lean_body_mass" |
-                "bone_mass_percentage" |
-                "protein_percentage" |
-                "skeletal_muscle_mass" |
-                "subcutaneous_fat_percentage" |
-                "body_age" |
-                "body_type" |
-                "head_size"):
-            pass
-          case _:
-            pass
-      encoder.write_weight_scale(timestamp=entry.time,
-                                 bmi=fields["bmi"],
-                                 weight=fields["weight"],
-                                 percent_fat=fields["body_fat"],
-                                 percent_hydration=fields["water"],
-                                 visceral_fat_mass=fields["visceral_fat_percentage"],
-                                 bone_mass=fields['bone_mass'],
-                                 muscle_mass=fields["muscle_mass"],
-                                 basal_met=fields["bmr"],
-                                 metabolic_age=fields["body_age"])
-
-    encoder.finish()
-    f.write(encoder.getvalue())
+  :param spec: file name optionally followed by a list of WeightEntry fields
+  :return: Sink for the specification
+  """
+  filename, fields = spec, None
+  if ":" in spec:
+    head, tail = spec.rsplit(":", 1)
+    if tail and "/" not in tail and "\\" not in tail:
+      filename, fields = head, tail.split(",")
+  if os.path.exists(filename):
+    sys.exit(f"File {filename} already exists, exiting\n")
+  if fields is not None:
+    unknown = [x for x in fields if x not in WeightEntry.__dataclass_fields__]
+    if unknown:
+      sys.exit(f"Unknown fields {', '.join(unknown)} for {filename}, exiting\n")
+  try:
+    return create_sink(filename, fields)
+  except ValueError as e:
+    sys.exit(f"{e}, exiting\n")
 
 
 def generate_column_table(table_data: list[tuple[str, str]],
@@ -415,6 +442,45 @@ def generate_date_table(table_data: list[datetime.datetime],
   return table
 
 
+def generate_stats_tables(summary: Summary) -> list[Table]:
+  """
+  Generate tables showing the statistics of an export
+
+  :param summary: Summary of the entries
+  :return: list with a table of periods and a table of family members
+  """
+  def number(value: float | None, digits: int = 2, sign: str = "") -> str:
+    # round first so that tiny negative values are not shown as -0.00
+    return "" if value is None else f"{round(value, digits) + 0.0:{sign}.{digits}f}"
+
+  period_table = Table(show_header=True, header_style="bold magenta")
+  for column in ("Family member", summary.period.capitalize(), "Readings", "Min weight", "Max weight",
+                 "Mean weight", "Mean body fat %", "Body fat change"):
+    period_table.add_column(column, justify="left" if column in ("Family member", "Day", "Week") else "right")
+  previous = {}
+  for member, key, stats in summary.sorted_groups():
+    body_fat = stats.body_fat_mean
+    change = None
+    if body_fat is not None and previous.get(member) is not None:
+      change = body_fat - previous[member]
+    if body_fat is not None:
+      previous[member] = body_fat
+    period_table.add_row(member, period_label(key, summary.period), str(stats.count),
+                         number(stats.weight_min if stats.weight_count else None),
+                         number(stats.weight_max if stats.weight_count else None),
+                         number(stats.weight_mean), number(body_fat, 1), number(change, 1, "+"))
+
+  member_table = Table(show_header=True, header_style="bold magenta")
+  member_table.add_column("Family member")
+  member_table.add_column("Readings", justify="right")
+  member_table.add_column("Body fat trend % per week", justify="right")
+  for member in sorted(summary.members):
+    trend = summary.body_fat_trends.get(member)
+    slope = trend.slope if trend is not None else None
+    member_table.add_row(member, str(summary.members[member]), number(slope, 2, "+"))
+  return [period_table, member_table]
+
+
 def select_dates(entries: list[WeightEntry]) -> tuple[datetime.date, datetime.date]:
   """
   Prompt users to select a range of dates from entries
@@ -460,13 +526,18 @@ def select_dates(entries: list[WeightEntry]) -> tuple[datetime.date, datetime.da
 @click.command("interactive", short_help="Interactively convert data")
 @click.option('--filename', help="File with data to import", required=True)
 @click.option('--output', help="File with data to export", required=True)
-def interactive_export(filename: str, output: str) -> None:
+@click.option('--profile', 'profile_files', multiple=True,
+              help="Json file with a source profile for non-Eufy csv files, may be repeated")
+@click.option('--verify', is_flag=True, help="Check the written fit file against the exported data")
+def interactive_export(filename: str, output: str, profile_files: tuple[str, ...], verify: bool) -> None:
   """
   Interactively export data to a Garmin compatible fit file.
   \f
 
   :param filename: string with name of file to open
   :param output: string with name of file to export to
+  :param profile_files: json files with additional source profiles
+  :param verify: check the written fit file against the exported data
   :return: None
   """
   if filename is None or output is None:
@@ -475,6 +546,7 @@ def interactive_export(filename: str, output: str) -> None:
     sys.exit(f"File {filename} does not exist, exiting\n")
   if os.path.exists(output):
     sys.exit(f"File {output} exists, exiting\n")
+  load_profiles(profile_files)
   entries = read_eufyfile(filename)
   columns = select_columns()
   start_time, end_time = select_dates(entries)
@@ -482,8 +554,7 @@ def interactive_export(filename: str, output: str) -> None:
   for entry in entries:
     if start_time <= entry.time <= end_time:
       filtered_entries.append(entry)
-  filtered_entries.sort(key=lambda x: x.time)
-  write_garmin_file(output, filtered_entries, columns)
+  write_garmin_file(output, sort_entries(filtered_entries), columns, verify=verify)
 
 
 @click.command('batch', short_help="Convert and export data automatically")
@@ -491,7 +562,41 @@ def interactive_export(filename: str, output: str) -> None:
 @click.option('--output', help="File with data to export", required=True)
 @click.option('--start', help="Start date in YYYY-MM-DD format", required=False)
 @click.option('--end', help="End date in YYYY-MM-DD format", required=False)
-def batch_export(filename: str, output: str, start, end) -> None:
+@click.option('--profile', 'profile_files', multiple=True,
+              help="Json file with a source profile for non-Eufy csv files, may be repeated")
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help="Number of processes used to parse large files")
+@click.option('--outliers', type=click.Choice(["drop", "flag"]), required=False,
+              help="Drop or flag readings that deviate from the rolling median of a family member")
+@click.option('--outlier-window', default=9, type=click.IntRange(min=3),
+              help="Number of previous readings used to detect outliers")
+@click.option('--outlier-threshold', default=3.5, type=click.FloatRange(min=0),
+              help="Allowed deviation from the rolling median in median absolute deviations")
+@click.option('--aggregate', required=False,
+              type=click.Choice([f"{how}-per-{period}" for how in filters.AGGREGATIONS for period in filters.PERIODS]),
+              help="Reduce readings to one per family member and day or week")
+@click.option('--sink', 'sink_specs', multiple=True,
+              help="Additional csv or jsonl output in FILE[:FIELD,FIELD...] format, may be repeated")
+@click.option('--compressed-timestamps', is_flag=True,
+              help="Use compressed timestamp headers for readings less than 32 seconds apart")
+@click.option('--fields', required=False,
+              help="Comma separated list of fields to write to the fit file, e.g. weight,body_fat")
+@click.option('--verify', is_flag=True, help="Check the written fit file against the exported data")
+@click.option('--append', is_flag=True,
+              help="Add readings newer than the last reading of an existing output file")
+@click.option('--memory-budget', default=DEFAULT_MEMORY_BUDGET, type=click.FloatRange(min=1),
+              help="Memory in MB used to sort readings before larger files are sorted on disk")
+@click.option('--on-error', default="exit", type=click.Choice(["exit", "skip"]),
+              help="Exit on the first row that cannot be converted or skip such rows")
+@click.option('--quarantine', 'quarantine_file', required=False,
+              help="Csv file that skipped rows are written to with their line number and reason")
+@click.option('--metrics', 'metrics_file', required=False,
+              help="File to write run metrics to, json for .json files and Prometheus text format otherwise")
+def batch_export(filename: str, output: str, start, end, profile_files: tuple[str, ...], workers: int,
+                 outliers: str, outlier_window: int, outlier_threshold: float, aggregate: str,
+                 sink_specs: tuple[str, ...], compressed_timestamps: bool, fields: str, verify: bool,
+                 append: bool, memory_budget: float, on_error: str,
+                 quarantine_file: str, metrics_file: str) -> None:
   """
   Export data from csv to fit file that Garmin Connect can import
 
@@ -499,40 +604,136 @@ def batch_export(filename: str, output: str, start, end) -> None:
   :param output: string with name of file to export to
   :param start: start date in YYYY-MM-DD format
   :param end: end date in YYYY-MM-DD format
+  :param profile_files: json files with additional source profiles
+  :param workers: number of processes used to parse the csv file
+  :param outliers: drop or flag outliers, None to disable the outlier filter
+  :param outlier_window: number of previous readings used to detect outliers
+  :param outlier_threshold: allowed deviation in median absolute deviations
+  :param aggregate: aggregation in {last,mean,min}-per-{day,week} format, None to export all readings
+  :param sink_specs: additional outputs in FILE[:FIELD,FIELD...] format
+  :param compressed_timestamps: use compressed timestamp headers in the fit file
+  :param fields: comma separated list of WeightEntry fields to write to the fit file
+  :param verify: check the written fit file against the exported data
+  :param append: add readings to an existing fit file
+  :param memory_budget: memory in MB used to sort readings in memory
+  :param on_error: exit or skip rows that cannot be converted
+  :param quarantine_file: csv file that skipped rows are written to
+  :param metrics_file: file to write run metrics to
   :return: None
   """
-  if filename is None:
-    sys.exit("Filename not specified, exiting\n")
-  if not os.path.exists(filename):
-    sys.exit("File does not exist, exiting\n")
-  entries = read_eufyfile(filename)
-  filtered_entries = []
-  date_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
-  if start is None:
-    start_time = datetime.datetime(2000,
-                                   1,
-                                   1, 0, 0, 0)
-  else:
-    if match := date_re.match(start):
-      start_time = datetime.datetime(int(match.group(1)),
-                                     int(match.group(2)),
-                                     int(match.group(3)), 0, 0, 0)
+  METRICS.reset()
+  quarantine = outlier_filter = None
+  exit_code = 1
+  try:
+    if filename is None:
+      sys.exit("Filename not specified, exiting\n")
+    if filename != STDIN and not os.path.exists(filename):
+      sys.exit("File does not exist, exiting\n")
+    load_profiles(profile_files)
+    start_time, end_time = parse_date_range(start, end)
+    selected_fields = None
+    if fields is not None:
+      selected_fields = [x.strip() for x in fields.split(",")]
+      if unknown := [x for x in selected_fields if x not in WeightEntry.__dataclass_fields__]:
+        sys.exit(f"Unknown fields {', '.join(unknown)}, exiting\n")
+    sinks = [parse_sink(x) for x in sink_specs]
+    if os.path.exists(output) and not append:
+      sys.exit("File already exists, exiting\n")
+    if quarantine_file is not None and os.path.exists(quarantine_file):
+      sys.exit(f"File {quarantine_file} already exists, exiting\n")
+    quarantine = Quarantine(quarantine_file)
+    if workers > 1:
+      entries = read_eufyfile(filename, workers, on_error, quarantine)
     else:
-      sys.exit("Start date must be in YYYY-MM-DD format, exiting\n")
+      entries = iter_eufyfile(filename, on_error, quarantine)
+    entries = METRICS.timed(entries, "read")
+    filtered_entries = sort_entries(filter_dates(entries, start_time, end_time), memory_budget)
+    if outliers is not None:
+      outlier_filter = OutlierFilter(window=outlier_window, threshold=outlier_threshold, action=outliers)
+      filtered_entries = outlier_filter(filtered_entries)
+    if aggregate is not None:
+      how, period = aggregate.split("-per-")
+      filtered_entries = filters.aggregate_entries(filtered_entries, how, period)
+    filtered_entries = METRICS.timed(filtered_entries, "filter")
+    write_garmin_file(output, filtered_entries, selected_fields, sinks=sinks,
+                      compressed_timestamps=compressed_timestamps, verify=verify, append=append)
+    if on_error == "skip":
+      click.echo(quarantine.summary())
+    if outlier_filter is not None:
+      click.echo(f"Outlier filter dropped {outlier_filter.dropped} and flagged {outlier_filter.flagged} readings")
+    exit_code = 0
+  except SystemExit as e:
+    exit_code = exit_status(e)
+    raise
+  finally:
+    # metrics are also written for failed runs, so that they can be alerted on
+    if quarantine is not None:
+      quarantine.close()
+    if metrics_file is not None:
+      if quarantine is not None:
+        METRICS.count("rows_rejected", quarantine.count)
+      if outlier_filter is not None:
+        METRICS.count("outliers_dropped", outlier_filter.dropped)
+      METRICS.set("exit_code", exit_code)
+      METRICS.set("success", int(exit_code == 0))
+      METRICS.write(metrics_file)
+
+
+def exit_status(error: SystemExit) -> int:
+  """
+  Get the status a process exits with for a SystemExit
 
-  if end is None:
-    end_time = datetime.datetime.now()
+  :param error: SystemExit raised with sys.exit
+  :return: 0 for no code, the code if it is an integer and 1 for a message
+  """
+  if error.code is None:
+    return 0
+  return error.code if isinstance(error.code, int) else 1
+
+
+@click.command('stats', short_help="Show per period statistics of an export")
+@click.option('--filename', help="File with data to summarize", required=True)
+@click.option('--start', help="Start date in YYYY-MM-DD format", required=False)
+@click.option('--end', help="End date in YYYY-MM-DD format", required=False)
+@click.option('--period', default="week", type=click.Choice(filters.PERIODS),
+              help="Length of the periods readings are grouped in")
+@click.option('--profile', 'profile_files', multiple=True,
+              help="Json file with a source profile for non-Eufy csv files, may be repeated")
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help="Number of processes used to parse large files")
+@click.option('--on-error', default="exit", type=click.Choice(["exit", "skip"]),
+              help="Exit on the first row that cannot be converted or skip such rows")
+def show_stats(filename: str, start, end, period: str, profile_files: tuple[str, ...], workers: int,
+               on_error: str) -> None:
+  """
+  Show weight and body fat statistics per family member and period
+
+  :param filename: string with name of file to open
+  :param start: start date in YYYY-MM-DD format
+  :param end: end date in YYYY-MM-DD format
+  :param period: day or week
+  :param profile_files: json files with additional source profiles
+  :param workers: number of processes used to parse the csv file
+  :param on_error: exit or skip rows that cannot be converted
+  :return: None
+  """
+  if filename != STDIN and not os.path.exists(filename):
+    sys.exit("File does not exist, exiting\n")
+  load_profiles(profile_files)
+  start_time, end_time = parse_date_range(start, end)
+  quarantine = Quarantine()
+  if workers > 1:
+    entries = read_eufyfile(filename, workers, on_error, quarantine)
   else:
-    if match := date_re.match(end):
-      end_time = datetime.datetime(int(match.group(1)),
-                                   int(match.group(2)),
-                                   int(match.group(3)), 23, 59, 59)
-    else:
-      sys.exit("End date must be in YYYY-MM-DD format, exiting\n")
-  for entry in entries:
-    if start_time <= entry.time <= end_time:
-      filtered_entries.append(entry)
-  write_garmin_file(output, filtered_entries)
+    entries = iter_eufyfile(filename, on_error, quarantine)
+  summary = Summary(period).update(x for x in entries if start_time <= x.time <= end_time)
+  console = Console()
+  for table in generate_stats_tables(summary):
+    console.print(table)
+  if summary.rows:
+    console.print(f"{summary.rows} readings from {summary.first:%Y-%m-%d} to {summary.last:%Y-%m-%d}")
+  if on_error == "skip":
+    console.print(quarantine.summary())
 
 
 @click.group()
@@ -543,4 +744,5 @@ def main() -> None:
 if __name__ == "__main__":
   main.add_command(interactive_export)
   main.add_command(batch_export)
+  main.add_command(show_stats)
   main()
@@ -0,0 +1,28 @@
+import datetime
+from dataclasses import dataclass, field
+
+
+@dataclass
+class WeightEntry:
+  time: datetime.datetime
+  weight: float = 0  # weight in kg
+  bmi: float = 0
+  body_fat: float = 0  # % of body weight due to fat
+  heart_rate: float = 0
+  muscle_mass: float = 0  # muscle mass in body in kg
+  muscle_mass_percent: float = 0  # % of body weight due to muscle
+  bmr: float = 0
+  water: float = 0  # mass of water in body in kg
+  body_fat_mass: float = 0  # fat in body in kg
+  lean_body_mass: float = 0  # lean body mass in kg
+  bone_mass: float = 0  # mass of bones in kg
+  bone_mass_percentage: float = 0  # % of body weight due to bones
+  visceral_fat_percentage: float = 0  # visceral fat percentagge
+  protein_percentage: float = 0  # % of protein in body
+  skeletal_muscle_mass: float = 0  # mass of skeletal muscle in kg
+  subcutaneous_fat_percentage: float = 0  # % of subcutaneous fat
+  body_age: float = 0  # estimated body age
+  body_type: str = ""  # body type categorization
+  head_size: float = 0  # size of head in cm
+  family_member: str = field(default="", compare=False)  # family member the reading belongs to
+  outlier: bool = field(default=False, compare=False)  # set when flagged by the outlier filter
@@ -0,0 +1,393 @@
+import bz2
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import os
+import sys
+import zipfile
+from dataclasses import dataclass
+from typing import IO, Iterable, Iterator, Union
+
+import profiles
+import scanner
+import sharding
+from entries import WeightEntry
+from fit import FitError
+from quarantine import Quarantine
+from sinks import FitSink, Sink, write_sinks
+from sorting import DEFAULT_MEMORY_BUDGET, sort_entries
+
+
+class ConversionError(Exception):
+  """
+  Base class for errors raised while converting an export
+  """
+
+
+class SourceError(ConversionError):
+  """
+  Raised when a source has no header that a source profile recognizes
+  """
+
+
+class RowError(ConversionError):
+  """
+  Raised when a row of a source cannot be converted
+  """
+
+  def __init__(self, name: str, line: int, kind: str, detail: str, row: list[str]):
+    """
+    :param name: name of the source
+    :param line: line number of the row
+    :param kind: kind of problem
+    :param detail: description of the problem
+    :param row: values of the row
+    """
+    super().__init__(f"Line {line} of {name}: {kind} {detail}".rstrip())
+    self.line = line
+    self.kind = kind
+    self.detail = detail
+    self.row = row
+
+
+class VerificationError(ConversionError):
+  """
+  Raised when a written FIT file does not match the converted entries
+  """
+
+
+@dataclass
+class Stats:
+  """
+  Counts collected during a conversion
+  """
+  rows_read: int = 0  # rows converted to entries
+  rows_skipped: int = 0  # rows that could not be converted
+  rows_filtered: int = 0  # entries outside of the requested time range
+  records_written: int = 0  # entries written to the output
+  bytes_written: int = 0  # size of the FIT output
+
+
+Source = Union[str, bytes, IO]
+
+STDIN = "-"
+# openers for files that are decompressed while they are read, zip archives are handled separately
+DECOMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open}
+COMPRESSED_EXTENSIONS = tuple(DECOMPRESSORS) + (".zip",)
+
+
+@contextlib.contextmanager
+def open_source(source: Source) -> Iterator[IO[str]]:
+  """
+  Open a source for csv reading
+
+  :param source: file name, bytes with the contents of a file, or a text or binary stream
+  :return: context manager giving a text stream, file names are closed on exit, streams are left open
+  """
+  if isinstance(source, str):
+    with open(source, "r", encoding="utf-8-sig", newline="") as stream:
+      yield stream
+  elif isinstance(source, (bytes, bytearray, memoryview)):
+    yield io.TextIOWrapper(io.BytesIO(source), encoding="utf-8-sig", newline="")
+  elif isinstance(source, io.TextIOBase):
+    yield source
+  else:
+    stream = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    try:
+      yield stream
+    finally:
+      stream.detach()
+
+
+def source_name(source: Source) -> str:
+  """
+  Get a name for a source to use in errors
+
+  :param source: file name or stream
+  :return: file name, name of the stream or <stream>
+  """
+  if isinstance(source, str):
+    return source
+  return getattr(source, "name", "<stream>")
+
+
+def is_plain_file(filename: str) -> bool:
+  """
+  Check if a file name refers to an uncompressed file that can be memory-mapped and sharded
+
+  :param filename: name of file, - for stdin
+  :return: True for uncompressed files
+  """
+  return filename != STDIN and not filename.lower().endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_members(filename: str) -> Iterator[tuple[str, IO[bytes]]]:
+  """
+  Open the csv data of a file as binary streams, gzip and bz2 files are
+  decompressed while they are read and every csv file in a zip archive is
+  opened in name order
+
+  :param filename: name of file, - for stdin
+  :return: iterator over (name, binary stream) tuples, streams are closed when the next one is opened
+  """
+  if filename == STDIN:
+    yield "<stdin>", sys.stdin.buffer
+    return
+  extension = os.path.splitext(filename)[1].lower()
+  if extension in DECOMPRESSORS:
+    with DECOMPRESSORS[extension](filename, "rb") as stream:
+      yield filename, stream
+  elif extension == ".zip":
+    with zipfile.ZipFile(filename) as archive:
+      members = sorted(x for x in archive.namelist()
+                       if x.lower().endswith(".csv") and not x.startswith("__MACOSX/"))
+      if not members:
+        raise SourceError(f"No csv file in {filename}")
+      for member in members:
+        with archive.open(member) as stream:
+          yield f"{filename}:{member}", stream
+  else:
+    with open(filename, "rb") as stream:
+      yield filename, stream
+
+
+def get_decoder(name: str, header: list[str], on_error: str = "raise",
+                quarantine: Quarantine = None) -> profiles.RowDecoder:
+  """
+  Get the decoder for the header of a source, with on_error set to skip columns
+  that are not known to any profile are ignored
+
+  :param name: name of the source
+  :param header: list of column names
+  :param on_error: raise or skip
+  :param quarantine: Quarantine that is told about ignored columns
+  :return: RowDecoder for the header
+  """
+  try:
+    if on_error == "skip":
+      decoder, unknown = profiles.get_partial_decoder(header)
+      if quarantine is not None:
+        quarantine.set_header(header, unknown)
+    else:
+      decoder = profiles.get_decoder(header)
+  except ValueError as e:
+    raise SourceError(f"Cannot decode {name}: {e}") from e
+  if decoder is None:
+    raise SourceError(f"Unrecognized header in {name}, no source profile matches")
+  return decoder
+
+
+def reject_row(name: str, line: int, kind: str, detail: str, row: list[str],
+               on_error: str = "raise", quarantine: Quarantine = None) -> None:
+  """
+  Handle a row that could not be converted, raises RowError unless on_error is skip
+
+  :param name: name of the source
+  :param line: line number of the row
+  :param kind: kind of problem
+  :param detail: description of the problem
+  :param row: values of the row
+  :param on_error: raise or skip
+  :param quarantine: Quarantine that receives skipped rows
+  :return: None
+  """
+  if on_error != "skip":
+    raise RowError(name, line, kind, detail, row)
+  if quarantine is not None:
+    quarantine.add(line, kind, detail, row)
+
+
+def iter_entries(stream: IO[str], on_error: str = "raise", quarantine: Quarantine = None,
+                 name: str = None) -> Iterator[WeightEntry]:
+  """
+  Parse a csv export one row at a time, the source profile used to decode
+  rows is selected from the header
+
+  :param stream: text stream opened with newline=''
+  :param on_error: raise on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :param name: name of the source used in errors
+  :return: iterator over WeightEntry objects
+  """
+  name = name or source_name(stream)
+  reader = csv.reader(stream)
+  try:
+    header = next(reader, None)
+  except csv.Error as e:
+    raise SourceError(f"Cannot read the header of {name}: {e}") from e
+  if header is None:
+    return
+  decoder = get_decoder(name, header, on_error, quarantine)
+  while True:
+    try:
+      row = next(reader)
+    except StopIteration:
+      return
+    except csv.Error as e:
+      reject_row(name, reader.line_num, "invalid csv", str(e), [], on_error, quarantine)
+      continue
+    if not row:
+      continue
+    try:
+      entry = WeightEntry(**decoder(row))
+    except (ValueError, TypeError, IndexError):
+      reject_row(name, reader.line_num, *decoder.diagnose(row), row, on_error, quarantine)
+      continue
+    yield entry
+
+
+def iter_file_entries(filename: str, on_error: str = "raise",
+                      quarantine: Quarantine = None) -> Iterator[WeightEntry]:
+  """
+  Parse a csv export from a memory-mapped file, lines are split at the byte
+  level and only quoted rows go through the csv module
+
+  :param filename: name of csv file
+  :param on_error: raise on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :return: iterator over WeightEntry objects
+  """
+  records = scanner.scan_file(filename)
+  first = next(records, None)
+  if first is None:
+    return
+  if isinstance(first[1], scanner.RecordError):
+    raise SourceError(f"Cannot read the header of {filename}: {first[1]}")
+  decoder = get_decoder(filename, first[1], on_error, quarantine)
+  for line, row in records:
+    if isinstance(row, scanner.RecordError):
+      reject_row(filename, line, row.kind, row.detail, row.row, on_error, quarantine)
+      continue
+    try:
+      entry = WeightEntry(**decoder(row))
+    except (ValueError, TypeError, IndexError):
+      reject_row(filename, line, *decoder.diagnose(row), row, on_error, quarantine)
+      continue
+    yield entry
+
+
+def iter_source_entries(source: Source, on_error: str = "raise",
+                        quarantine: Quarantine = None) -> Iterator[WeightEntry]:
+  """
+  Parse a csv export from any source, plain files are memory-mapped,
+  compressed files and zip archives are decompressed while they are read
+
+  :param source: file name, - for stdin, bytes with the contents of a file, or a text or binary stream
+  :param on_error: raise on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :return: iterator over WeightEntry objects
+  """
+  if not isinstance(source, str):
+    try:
+      with open_source(source) as stream:
+        yield from iter_entries(stream, on_error, quarantine, source_name(source))
+    except UnicodeDecodeError as e:
+      raise SourceError(f"Cannot read {source_name(source)}: {e}") from e
+  elif is_plain_file(source):
+    yield from iter_file_entries(source, on_error, quarantine)
+  else:
+    try:
+      for name, member in open_members(source):
+        with open_source(member) as stream:
+          yield from iter_entries(stream, on_error, quarantine, name)
+    except (OSError, EOFError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+      raise SourceError(f"Cannot read {source}: {e}") from e
+
+
+def read_entries_sharded(filename: str, workers: int, on_error: str = "raise",
+                         quarantine: Quarantine = None) -> list[WeightEntry]:
+  """
+  Parse a csv export in parallel worker processes
+
+  :param filename: name of csv file
+  :param workers: number of worker processes
+  :param on_error: raise on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :return: list of WeightEntry objects in file order
+  """
+  try:
+    header, data_start = sharding.read_header(filename)
+  except UnicodeDecodeError as e:
+    raise SourceError(f"Cannot read the header of {filename}: {e}") from e
+  if not header:
+    return []
+  decoder = get_decoder(filename, header, on_error, quarantine)
+  columns, errors = sharding.parse_sharded(filename, decoder.profile, header, data_start, workers)
+  for line, kind, detail, row in errors:
+    reject_row(filename, line, kind, detail, row, on_error, quarantine)
+  return [WeightEntry(**dict(zip(decoder.fields, values))) for values in zip(*columns)]
+
+
+def time_range(start: datetime.date = None, end: datetime.date = None) -> tuple[datetime.datetime, datetime.datetime]:
+  """
+  Get the inclusive time range for optional start and end dates, a date
+  without a time covers the whole day
+
+  :param start: first date or time to include, None for no limit
+  :param end: last date or time to include, None for no limit
+  :return: tuple with start and end times
+  """
+  if start is None:
+    start = datetime.datetime.min
+  elif not isinstance(start, datetime.datetime):
+    start = datetime.datetime.combine(start, datetime.time.min)
+  if end is None:
+    end = datetime.datetime.max
+  elif not isinstance(end, datetime.datetime):
+    end = datetime.datetime.combine(end, datetime.time.max)
+  return start, end
+
+
+def convert(source: Source, sink: Union[IO[bytes], Sink], start: datetime.date = None,
+            end: datetime.date = None, fields: list[str] = None, on_error: str = "raise",
+            quarantine: Quarantine = None, memory_budget: float = DEFAULT_MEMORY_BUDGET,
+            compressed_timestamps: bool = False, verify: bool = False) -> Stats:
+  """
+  Convert a csv export to a FIT file
+
+  :param source: file name, - for stdin, bytes with the contents of a file, or a text or binary stream,
+                 .gz, .bz2 and .zip files are decompressed while they are read
+  :param sink: binary stream or file name that receives the FIT file, or a Sink
+  :param start: first date or time to include, None for no limit
+  :param end: last date or time to include, None for no limit
+  :param fields: list of WeightEntry fields to write, None for the default fields
+  :param on_error: raise on the first row that cannot be converted, or skip such rows
+  :param quarantine: Quarantine that receives skipped rows
+  :param memory_budget: memory in MB used to sort entries before spilling to temporary files
+  :param compressed_timestamps: use compressed timestamp headers for records close together in time
+  :param verify: decode the written FIT data and check it against the entries
+  :return: Stats for the conversion
+  """
+  if not isinstance(sink, Sink):
+    sink = FitSink(sink, fields, compressed_timestamps=compressed_timestamps, verify=verify)
+  if quarantine is None:
+    quarantine = Quarantine()
+  start, end = time_range(start, end)
+  stats = Stats()
+
+  def in_range(entries: Iterable[WeightEntry]) -> Iterator[WeightEntry]:
+    for entry in entries:
+      stats.rows_read += 1
+      try:
+        included = start <= entry.time <= end
+      except TypeError as e:
+        # e.g. a timezone aware start or end compared with the naive times of the export
+        raise SourceError(f"Cannot compare the times in {source_name(source)} with the requested range: {e}") from e
+      if included:
+        yield entry
+      else:
+        stats.rows_filtered += 1
+
+  entries = iter_source_entries(source, on_error, quarantine)
+  write_sinks(sort_entries(in_range(entries), memory_budget), [sink])
+  stats.rows_skipped = quarantine.count
+  stats.records_written = sink.count
+  stats.bytes_written = getattr(sink, "size", 0)
+  if verify and isinstance(sink, FitSink):
+    try:
+      sink.verify()
+    except FitError as e:
+      raise VerificationError(str(e)) from e
+  return stats
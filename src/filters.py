@@ -0,0 +1,209 @@
+from bisect import bisect_left, insort
+from collections import deque
+from dataclasses import dataclass, field, fields, replace
+from typing import Iterable, Iterator
+
+# scale factor making the median absolute deviation comparable to a standard deviation
+MAD_SCALE = 1.4826
+
+
+@dataclass
+class OutlierFilter:
+  """
+  Streaming filter that drops or flags weigh-ins deviating too far from the
+  rolling median of the previous readings of the same family member
+
+  The accepted range is only recomputed when a reading enters the window.
+  When reseed consecutive readings are rejected but agree with each other,
+  e.g. after a real change of weight over a long gap, they replace the window
+  and the last of them is accepted.
+  """
+  window: int = 9  # number of accepted readings per family member used for the median
+  threshold: float = 3.5  # allowed deviation in scaled median absolute deviations
+  min_deviation: float = 2.0  # deviation in kg that is always accepted
+  action: str = "drop"  # drop or flag outliers
+  min_samples: int = 3  # readings needed before outliers are detected
+  reseed: int = 3  # consecutive rejected readings within min_deviation that restart the window
+  dropped: int = 0
+  flagged: int = 0
+  _history: dict[str, deque] = field(default_factory=dict, repr=False)
+  _sorted: dict[str, list[float]] = field(default_factory=dict, repr=False)
+  _limits: dict[str, tuple[float, float]] = field(default_factory=dict, repr=False)  # median, allowed deviation
+  _rejected: dict[str, deque] = field(default_factory=dict, repr=False)
+
+  def __post_init__(self):
+    if self.action not in ("drop", "flag"):
+      raise ValueError(f"Unknown outlier action {self.action}")
+    if self.reseed < 1:
+      raise ValueError("reseed must be at least 1")
+
+  def is_outlier(self, member: str, weight: float) -> bool:
+    """
+    Check a reading against the window of a family member and add it to the
+    window if it is accepted
+
+    :param member: family member the reading belongs to
+    :param weight: weight in kg
+    :return: True if the reading is an outlier
+    """
+    limits = self._limits.get(member)
+    if limits is not None and abs(weight - limits[0]) > limits[1]:
+      rejected = self._rejected.setdefault(member, deque(maxlen=self.reseed))
+      rejected.append(weight)
+      if len(rejected) < self.reseed or max(rejected) - min(rejected) > self.min_deviation:
+        return True
+      self._history[member] = deque()
+      self._sorted[member] = []
+      for value in list(rejected)[:-1]:
+        self._add(member, value)
+    self._add(member, weight)
+    return False
+
+  def _add(self, member: str, weight: float) -> None:
+    """
+    Add an accepted reading to the window of a family member and update its accepted range
+    """
+    history = self._history.setdefault(member, deque())
+    window = self._sorted.setdefault(member, [])
+    history.append(weight)
+    insort(window, weight)
+    if len(window) > self.window:
+      window.remove(history.popleft())
+    self._rejected.pop(member, None)
+    if len(window) >= self.min_samples:
+      median = _median(window)
+      self._limits[member] = (median, max(self.threshold * _mad(window, median) * MAD_SCALE, self.min_deviation))
+    else:
+      self._limits.pop(member, None)
+
+  def __call__(self, entries: Iterable) -> Iterator:
+    """
+    Filter a stream of entries, readings without a weight are passed through
+
+    :param entries: iterable of WeightEntry objects
+    :return: iterator over entries that are kept
+    """
+    for entry in entries:
+      if entry.weight and self.is_outlier(entry.family_member, entry.weight):
+        if self.action == "drop":
+          self.dropped += 1
+          continue
+        entry.outlier = True
+        self.flagged += 1
+      yield entry
+
+
+AGGREGATIONS = ("last", "mean", "min")
+PERIODS = ("day", "week")
+
+
+def period_key(time, period: str) -> tuple:
+  """
+  Key identifying the time bucket a timestamp falls in
+
+  :param time: datetime of a reading
+  :param period: day or week
+  :return: tuple identifying the bucket
+  """
+  if period == "day":
+    return time.year, time.month, time.day
+  iso = time.isocalendar()
+  return iso[0], iso[1]
+
+
+def aggregate_entries(entries: Iterable, how: str, period: str) -> Iterator:
+  """
+  Reduce entries sorted by time to one entry per family member and period
+
+  Entries are grouped in a single pass, a group is emitted as soon as an entry
+  from a later period is seen.  With mean aggregation numeric fields are
+  averaged over the readings that have a value and the other fields are
+  taken from the last reading.
+
+  :param entries: iterable of WeightEntry objects sorted by time
+  :param how: last, mean or min
+  :param period: day or week
+  :return: iterator over aggregated entries
+  """
+  if how not in AGGREGATIONS:
+    raise ValueError(f"Unknown aggregation {how}")
+  if period not in PERIODS:
+    raise ValueError(f"Unknown aggregation period {period}")
+  current_key = None
+  groups: dict[str, list] = {}
+  for entry in entries:
+    key = period_key(entry.time, period)
+    if key != current_key:
+      if current_key is not None and key < current_key:
+        raise ValueError("Entries must be sorted by time to be aggregated")
+      yield from _reduce_groups(groups, how)
+      groups = {}
+      current_key = key
+    groups.setdefault(entry.family_member, []).append(entry)
+  yield from _reduce_groups(groups, how)
+
+
+def _reduce_groups(groups: dict[str, list], how: str) -> Iterator:
+  """
+  Reduce the groups of one period
+
+  :param groups: dict mapping family members to their entries in the period
+  :param how: last, mean or min
+  :return: iterator over one entry per family member, ordered by time
+  """
+  reduced = []
+  for group in groups.values():
+    match how:
+      case "last":
+        reduced.append(group[-1])
+      case "min":
+        reduced.append(min(group, key=lambda x: x.weight if x.weight else float("inf")))
+      case "mean":
+        means = {}
+        for entry_field in fields(group[-1]):
+          if entry_field.type is not float and entry_field.type != "float":
+            continue
+          values = [getattr(x, entry_field.name) for x in group if getattr(x, entry_field.name)]
+          means[entry_field.name] = sum(values) / len(values) if values else 0
+        reduced.append(replace(group[-1], **means))
+  reduced.sort(key=lambda x: x.time)
+  return iter(reduced)
+
+
+def _median(values: list[float]) -> float:
+  """
+  Median of a sorted list
+
+  :param values: sorted list of values
+  :return: median value
+  """
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2
+
+
+def _mad(values: list[float], median: float) -> float:
+  """
+  Median absolute deviation of a sorted list in linear time, the deviations of
+  the values below and above the median are already sorted and are merged
+
+  :param values: sorted list of values
+  :param median: median of the values
+  :return: median of the absolute deviations from the median
+  """
+  split = bisect_left(values, median)
+  below = split - 1
+  above = split
+  deviations = []
+  needed = len(values) // 2 + 1
+  while len(deviations) < needed:
+    if above >= len(values) or (below >= 0 and median - values[below] <= values[above] - median):
+      deviations.append(median - values[below])
+      below -= 1
+    else:
+      deviations.append(values[above] - median)
+      above += 1
+  if len(values) % 2:
+    return deviations[-1]
+  return (deviations[-2] + deviations[-1]) / 2
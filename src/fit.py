@@ -1,9 +1,15 @@
 from io import BytesIO
 from struct import pack
-from struct import unpack
+from struct import pack_into
+from struct import Struct
+from struct import unpack_from
+from struct import calcsize
+from struct import error as StructError
 from datetime import datetime
 import time
 
+from metrics import METRICS
+
 # Copied from https://github.com/jaroslawhartman/withings-sync/blob/master/withings_sync/fit.py
 # Originally MIT Licensed code by Jarek Hartman
 
@@ -22,6 +28,53 @@ def _calcCRC(crc, byte):
     return crc
 
 
+# byte wise table for the FIT crc, derived from the nibble wise calculation above
+_CRC_TABLE = [_calcCRC(0, byte) for byte in range(256)]
+
+
+def crc16(data, crc=0):
+    """compute the FIT crc of a bytes-like object, crc is the state after any preceding data"""
+    table = _CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def _crc16_zeros_matrix():
+    """the FIT crc update for a zero byte as a GF(2) matrix, one int per column"""
+    return [(1 << i >> 8) ^ _CRC_TABLE[(1 << i) & 0xFF] for i in range(16)]
+
+
+def _gf2_times(matrix, vector):
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+def crc16_shift(crc, length):
+    """compute the crc state after length zero bytes in O(log length) steps
+
+    the crc is linear, so crc16(data, a) ^ crc16(data, b) == crc16_shift(a ^ b, len(data)),
+    which allows the crc of a file to be updated when bytes before some data change"""
+    matrix = _crc16_zeros_matrix()
+    while length:
+        if length & 1:
+            crc = _gf2_times(matrix, crc)
+        length >>= 1
+        if length:
+            matrix = [_gf2_times(matrix, x) for x in matrix]
+    return crc
+
+
+class FitError(Exception):
+    """raised when a FIT file is malformed or does not match the expected content"""
+
+
 class FitBaseType(object):
     """BaseType Definition
 
@@ -72,16 +125,181 @@ class Fit(object):
     }
 
 
+class FitMessageSchema(object):
+    """Declarative description of a FIT message
+
+    fields is a list of (name, field number, base type, scale) tuples, the
+    schema is compiled into a packer for each set of fields that is written.
+    msg_number is the global message number, None looks it up in Fit.GMSG_NUMS"""
+
+    def __init__(self, name, fields, msg_number=None):
+        self.name = name
+        if msg_number is None:
+            if name not in Fit.GMSG_NUMS:
+                raise ValueError('No global message number for %s' % name)
+            msg_number = Fit.GMSG_NUMS[name]
+        self.msg_number = msg_number
+        self.fields = fields
+        self.field_names = tuple(x[0] for x in fields)
+        self._compiled = {}
+
+    def compile(self, field_names=None):
+        """return the cached packer for a set of fields, None selects all fields in schema order"""
+        field_names = self.field_names if field_names is None else tuple(field_names)
+        compiled = self._compiled.get(field_names)
+        if compiled is None:
+            compiled = CompiledMessage(self, field_names)
+            self._compiled[field_names] = compiled
+        return compiled
+
+
+class CompiledMessage(object):
+    """Definition message content and struct based record packer for a set of fields of a message"""
+
+    def __init__(self, schema, field_names):
+        by_name = {x[0]: x for x in schema.fields}
+        unknown = [x for x in field_names if x not in by_name]
+        if unknown:
+            raise ValueError('Unknown %s fields: %s' % (schema.name, ', '.join(unknown)))
+        fields = [by_name[x] for x in field_names]
+        self.schema = schema
+        self.field_names = field_names
+        # reserved, architecture(0: little endian), global message number, number of fields
+        self.definition = pack('<BBHB', 0, 0, schema.msg_number, len(fields)) + b''.join(
+            pack('BBB', num, basetype['size'], basetype['field']) for _, num, basetype, _ in fields)
+        self.formats = [FitBaseType.get_format(basetype) for _, _, basetype, _ in fields]
+        self.struct = Struct('<' + ''.join(self.formats))
+        self.size = self.struct.size
+        # name, invalid value, scale and whether the value is stored as an integer
+        self.converters = [(name, basetype['invalid'], scale if scale != 1 else None, basetype['#'] in _INT_TYPES)
+                           for name, _, basetype, scale in fields]
+
+    def field_offset(self, name):
+        """offset of a field in a packed record"""
+        return calcsize('<' + ''.join(self.formats[:self.field_names.index(name)]))
+
+    def pack(self, values):
+        """pack a record from a dict of values, missing and None values are written as invalid"""
+        packed = []
+        for name, invalid, scale, is_int in self.converters:
+            value = values.get(name)
+            if value is None:
+                value = invalid
+            else:
+                if scale is not None:
+                    value *= scale
+                if is_int:
+                    value = int(value)
+            packed.append(value)
+        try:
+            return self.struct.pack(*packed)
+        except StructError as e:
+            raise FitError('Cannot pack %s record: %s' % (self.schema.name, e))
+
+
+_INT_TYPES = (0, 1, 2, 3, 4, 5, 6, 10, 11, 12)
+_BASE_TYPES = {x['#']: x for x in (
+    FitBaseType.enum, FitBaseType.sint8, FitBaseType.uint8, FitBaseType.sint16, FitBaseType.uint16,
+    FitBaseType.sint32, FitBaseType.uint32, FitBaseType.string, FitBaseType.float32, FitBaseType.float64,
+    FitBaseType.uint8z, FitBaseType.uint16z, FitBaseType.uint32z, FitBaseType.byte)}
+
+MESSAGE_SCHEMAS = {
+    'file_id': FitMessageSchema('file_id', [
+        ('serial_number', 3, FitBaseType.uint32z, None),
+        ('time_created', 4, FitBaseType.uint32, None),
+        ('manufacturer', 1, FitBaseType.uint16, None),
+        ('product', 2, FitBaseType.uint16, None),
+        ('number', 5, FitBaseType.uint16, None),
+        ('type', 0, FitBaseType.enum, None),
+    ]),
+    'file_creator': FitMessageSchema('file_creator', [
+        ('software_version', 0, FitBaseType.uint16, None),
+        ('hardware_version', 1, FitBaseType.uint8, None),
+    ]),
+    'device_info': FitMessageSchema('device_info', [
+        ('timestamp', 253, FitBaseType.uint32, 1),
+        ('serial_number', 3, FitBaseType.uint32z, 1),
+        ('cum_operating_time', 7, FitBaseType.uint32, 1),
+        ('unknown_8', 8, FitBaseType.uint32, None),  # unknown field(undocumented)
+        ('manufacturer', 2, FitBaseType.uint16, 1),
+        ('product', 4, FitBaseType.uint16, 1),
+        ('software_version', 5, FitBaseType.uint16, 100),
+        ('battery_voltage', 10, FitBaseType.uint16, 256),
+        ('device_index', 0, FitBaseType.uint8, 1),
+        ('device_type', 1, FitBaseType.uint8, 1),
+        ('hardware_version', 6, FitBaseType.uint8, 1),
+        ('battery_status', 11, FitBaseType.uint8, None),
+    ]),
+    'weight_scale': FitMessageSchema('weight_scale', [
+        ('timestamp', 253, FitBaseType.uint32, 1),
+        ('weight', 0, FitBaseType.uint16, 100),
+        ('percent_fat', 1, FitBaseType.uint16, 100),
+        ('percent_hydration', 2, FitBaseType.uint16, 100),
+        ('visceral_fat_mass', 3, FitBaseType.uint16, 100),
+        ('bone_mass', 4, FitBaseType.uint16, 100),
+        ('muscle_mass', 5, FitBaseType.uint16, 100),
+        ('basal_met', 7, FitBaseType.uint16, 4),
+        ('active_met', 9, FitBaseType.uint16, 4),
+        ('physique_rating', 8, FitBaseType.uint8, 1),
+        ('metabolic_age', 10, FitBaseType.uint8, 1),
+        ('visceral_fat_rating', 11, FitBaseType.uint8, 1),
+        ('bmi', 13, FitBaseType.uint16, 10),
+    ]),
+    'blood_pressure': FitMessageSchema('blood_pressure', [
+        ('timestamp', 253, FitBaseType.uint32, 1),
+        ('systolic_pressure', 0, FitBaseType.uint16, 1),
+        ('diastolic_pressure', 1, FitBaseType.uint16, 1),
+        ('mean_arterial_pressure', 2, FitBaseType.uint16, 1),
+        ('map_3_sample_mean', 3, FitBaseType.uint16, 1),
+        ('map_morning_values', 4, FitBaseType.uint16, 1),
+        ('map_evening_values', 5, FitBaseType.uint16, 1),
+        ('heart_rate', 6, FitBaseType.uint8, 1),
+        ('heart_rate_type', 7, FitBaseType.enum, None),
+        ('status', 8, FitBaseType.enum, None),
+        ('user_profile_index', 9, FitBaseType.uint16, 1),
+    ]),
+}
+
+
+def field_limits(name, field):
+    """lowest and highest value of an integer field that can be packed, before scaling,
+    the invalid value is left out. None for other fields"""
+    _, _, basetype, scale = next(x for x in MESSAGE_SCHEMAS[name].fields if x[0] == field)
+    if basetype['#'] not in _INT_TYPES:
+        return None
+    bits = basetype['size'] * 8
+    if basetype['#'] in (1, 3, 5):  # signed types
+        low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    else:
+        low, high = 0, (1 << bits) - 1
+    if basetype['invalid'] == high:
+        high -= 1
+    elif basetype['invalid'] == low:
+        low += 1
+    scale = scale or 1
+    return low / scale, high / scale
+
+
+def register_message(schema):
+    """add a message schema so it can be written with FitEncoder.write_message"""
+    Fit.GMSG_NUMS.setdefault(schema.name, schema.msg_number)
+    MESSAGE_SCHEMAS[schema.name] = schema
+    _TEMPLATES.clear()
+
+
 class FitEncoder(Fit):
     FILE_TYPE = 9
-    LMSG_TYPE_FILE_INFO = 0
-    LMSG_TYPE_FILE_CREATOR = 1
-    LMSG_TYPE_DEVICE_INFO = 2
+    LMSG_TYPE_MAX = 15
+    LMSG_TYPE_MAX_COMPRESSED = 3  # compressed timestamp headers can only refer to local types 0-3
 
     def __init__(self):
         self.buf = BytesIO()
         self.write_header()  # create header first
-        self.device_info_defined = False
+        self.local_types = {}  # compiled message -> local message type
+        self.local_type_owners = {}  # local message type -> compiled message
+        self.local_type_used = {}  # local message type -> sequence number of last use
+        self.messages_written = 0
+        self.last_timestamp = None
 
     def __str__(self):
         orig_pos = self.buf.tell()
@@ -104,114 +322,88 @@ class FitEncoder(Fit):
         s = pack('BBHI4s', header_size, protocol_version, profile_version, data_size, data_type)
         self.buf.write(s)
 
-    def _build_content_block(self, content):
-        field_defs = []
-        values = []
-        for num, basetype, value, scale in content:
-            s = pack('BBB', num, basetype['size'], basetype['field'])
-            field_defs.append(s)
-            if value is None:
-                # invalid value
-                value = basetype['invalid']
-            elif scale is not None:
-                value *= scale
-            values.append(FitBaseType.pack(basetype, value))
-        return (b''.join(field_defs), b''.join(values))
+    def write_message(self, name, fields=None, compressed_timestamp=None, **values):
+        """write a record of a registered message, defining the local message type if needed
+
+        fields is the tuple of field names to define, None defines every field of the message.
+        compressed_timestamp is a fit timestamp written in a compressed timestamp header, the
+        fields then should not include the timestamp field"""
+        compiled = MESSAGE_SCHEMAS[name].compile(fields)
+        lmsg_type = self.local_type(compiled, compressed_timestamp is not None)
+        if compressed_timestamp is None:
+            header = self.record_header(lmsg_type=lmsg_type)
+            if values.get('timestamp') is not None:
+                self.last_timestamp = int(values['timestamp'])
+        else:
+            header = self.record_header(lmsg_type=lmsg_type, time_offset=compressed_timestamp)
+            self.last_timestamp = compressed_timestamp
+        self.buf.write(header + compiled.pack(values))
+
+    def local_type(self, compiled, compressed=False):
+        """return the local message type for a record of a compiled message, marking it as used"""
+        self.messages_written += 1
+        lmsg_type = self.define(compiled, compressed)
+        self.local_type_used[lmsg_type] = self.messages_written
+        return lmsg_type
+
+    def define(self, compiled, compressed=False):
+        """return the local message type for a compiled message, writing a definition message
+        when it is not currently defined. The least recently used local type is redefined
+        when all local types are in use"""
+        lmsg_type = self.local_types.get(compiled)
+        max_type = self.LMSG_TYPE_MAX_COMPRESSED if compressed else self.LMSG_TYPE_MAX
+        if lmsg_type is None or self.local_type_owners.get(lmsg_type) is not compiled or lmsg_type > max_type:
+            free = [x for x in range(max_type + 1) if x not in self.local_type_owners]
+            if free:
+                lmsg_type = free[0]
+            else:
+                lmsg_type = min(range(max_type + 1), key=self.local_type_used.__getitem__)
+            self.buf.write(self.record_header(definition=True, lmsg_type=lmsg_type) + compiled.definition)
+            self.local_types[compiled] = lmsg_type
+            self.local_type_owners[lmsg_type] = compiled
+            self.local_type_used[lmsg_type] = self.messages_written
+        return lmsg_type
 
     def write_file_info(self, serial_number=None, time_created=None, manufacturer=None, product=None, number=None):
         if time_created is None:
             time_created = datetime.now()
-
-        content = [
-            (3, FitBaseType.uint32z, serial_number, None),
-            (4, FitBaseType.uint32, self.timestamp(time_created), None),
-            (1, FitBaseType.uint16, manufacturer, None),
-            (2, FitBaseType.uint16, product, None),
-            (5, FitBaseType.uint16, number, None),
-            (0, FitBaseType.enum, self.FILE_TYPE, None),  # type
-        ]
-        fields, values = self._build_content_block(content)
-
-        # create fixed content
-        msg_number = self.GMSG_NUMS['file_id']
-        fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-
-        self.buf.write(b''.join([
-            # definition
-            self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_FILE_INFO),
-            fixed_content,
-            fields,
-            # record
-            self.record_header(lmsg_type=self.LMSG_TYPE_FILE_INFO),
-            values,
-        ]))
+        self.write_message('file_id', serial_number=serial_number, time_created=self.timestamp(time_created),
+                           manufacturer=manufacturer, product=product, number=number, type=self.FILE_TYPE)
 
     def write_file_creator(self, software_version=None, hardware_version=None):
-        content = [
-            (0, FitBaseType.uint16, software_version, None),
-            (1, FitBaseType.uint8, hardware_version, None),
-        ]
-        fields, values = self._build_content_block(content)
-
-        msg_number = self.GMSG_NUMS['file_creator']
-        fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-        self.buf.write(b''.join([
-            # definition
-            self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-            fixed_content,
-            fields,
-            # record
-            self.record_header(lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-            values,
-        ]))
+        self.write_message('file_creator', software_version=software_version, hardware_version=hardware_version)
 
     def write_device_info(self, timestamp, serial_number=None, cum_operationg_time=None, manufacturer=None,
                           product=None, software_version=None, battery_voltage=None, device_index=None,
                           device_type=None, hardware_version=None, battery_status=None):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (3, FitBaseType.uint32z, serial_number, 1),
-            (7, FitBaseType.uint32, cum_operationg_time, 1),
-            (8, FitBaseType.uint32, None, None),  # unknown field(undocumented)
-            (2, FitBaseType.uint16, manufacturer, 1),
-            (4, FitBaseType.uint16, product, 1),
-            (5, FitBaseType.uint16, software_version, 100),
-            (10, FitBaseType.uint16, battery_voltage, 256),
-            (0, FitBaseType.uint8, device_index, 1),
-            (1, FitBaseType.uint8, device_type, 1),
-            (6, FitBaseType.uint8, hardware_version, 1),
-            (11, FitBaseType.uint8, battery_status, None),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.device_info_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-            msg_number = self.GMSG_NUMS['device_info']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.device_info_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-        self.buf.write(header + values)
-
-    def record_header(self, definition=False, lmsg_type=0):
+        self.write_message('device_info', timestamp=self.timestamp(timestamp), serial_number=serial_number,
+                           cum_operating_time=cum_operationg_time, manufacturer=manufacturer, product=product,
+                           software_version=software_version, battery_voltage=battery_voltage,
+                           device_index=device_index, device_type=device_type, hardware_version=hardware_version,
+                           battery_status=battery_status)
+
+    def write_blood_pressure(self, timestamp, heart_rate=None, systolic_pressure=None, diastolic_pressure=None,
+                             mean_arterial_pressure=None, heart_rate_type=None, status=None,
+                             user_profile_index=None, fields=None):
+        """fields is the tuple of blood_pressure fields to define, None defines all fields"""
+        self.write_message('blood_pressure', fields=fields, timestamp=self.timestamp(timestamp),
+                           heart_rate=heart_rate, systolic_pressure=systolic_pressure,
+                           diastolic_pressure=diastolic_pressure, mean_arterial_pressure=mean_arterial_pressure,
+                           heart_rate_type=heart_rate_type, status=status, user_profile_index=user_profile_index)
+
+    def record_header(self, definition=False, lmsg_type=0, time_offset=None):
+        """time_offset creates a compressed timestamp header, only local message types 0-3 can be used"""
+        if time_offset is not None:
+            # bit 7 marks a compressed timestamp header, bits 5-6 are the local message type
+            return pack('B', 0x80 | (lmsg_type << 5) | (time_offset & 0x1F))
         msg = 0
         if definition:
             msg = 1 << 6  # 6th bit is a definition message
         return pack('B', msg + lmsg_type)
 
     def crc(self):
-        orig_pos = self.buf.tell()
-        self.buf.seek(0)
-
-        crc = 0
-        while True:
-            b = self.buf.read(1)
-            if not b:
-                break
-            crc = _calcCRC(crc, unpack('b', b)[0])
-        self.buf.seek(orig_pos)
-        return pack('H', crc)
+        with self.buf.getbuffer() as view:
+            return pack('<H', crc16(view))
 
     def finish(self):
         """re-weite file-header, then append crc to end of file"""
@@ -220,6 +412,8 @@ class FitEncoder(Fit):
         crc = self.crc()
         self.buf.seek(0, 2)
         self.buf.write(crc)
+        METRICS.count('fit_messages_encoded', self.messages_written)
+        METRICS.count('fit_bytes_encoded', self.get_size())
 
     def get_size(self):
         orig_pos = self.buf.tell()
@@ -240,39 +434,358 @@ class FitEncoder(Fit):
 
 
 class FitEncoderWeight(FitEncoder):
-    LMSG_TYPE_WEIGHT_SCALE = 3
+    MAX_TIME_OFFSET = 31
 
-    def __init__(self):
+    def __init__(self, compressed_timestamps=False, anchor_interval=32, fields=None):
+        """compressed_timestamps writes records less than 32s apart with a compressed timestamp header,
+        a full timestamp is written at least every anchor_interval records.
+        fields is the list of weight_scale fields to define, None defines all fields"""
         super().__init__()
-        self.weight_scale_defined = False
+        self.compressed_timestamps = compressed_timestamps
+        self.anchor_interval = anchor_interval
+        self.fields = fields
+        self.compressed_run = 0
 
-    def write_weight_scale(self, timestamp, weight, percent_fat=None, percent_hydration=None,
+    def write_weight_scale(self, timestamp, weight=None, percent_fat=None, percent_hydration=None,
                            visceral_fat_mass=None, bone_mass=None, muscle_mass=None, basal_met=None,
                            active_met=None, physique_rating=None, metabolic_age=None,
-                           visceral_fat_rating=None, bmi=None):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (0, FitBaseType.uint16, weight, 100),
-            (1, FitBaseType.uint16, percent_fat, 100),
-            (2, FitBaseType.uint16, percent_hydration, 100),
-            (3, FitBaseType.uint16, visceral_fat_mass, 100),
-            (4, FitBaseType.uint16, bone_mass, 100),
-            (5, FitBaseType.uint16, muscle_mass, 100),
-            (7, FitBaseType.uint16, basal_met, 4),
-            (9, FitBaseType.uint16, active_met, 4),
-            (8, FitBaseType.uint8, physique_rating, 1),
-            (10, FitBaseType.uint8, metabolic_age, 1),
-            (11, FitBaseType.uint8, visceral_fat_rating, 1),
-            (13, FitBaseType.uint16, bmi, 10),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.weight_scale_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-            msg_number = self.GMSG_NUMS['weight_scale']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.weight_scale_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-        self.buf.write(header + values)
\ No newline at end of file
+                           visceral_fat_rating=None, bmi=None, fields=None):
+        """fields overrides the list of fields given to the encoder for this record"""
+        if fields is None:
+            fields = self.fields
+        field_names = self.weight_scale_fields(fields)
+        fit_timestamp = int(self.timestamp(timestamp))
+        values = dict(weight=weight, percent_fat=percent_fat, percent_hydration=percent_hydration,
+                      visceral_fat_mass=visceral_fat_mass, bone_mass=bone_mass, muscle_mass=muscle_mass,
+                      basal_met=basal_met, active_met=active_met, physique_rating=physique_rating,
+                      metabolic_age=metabolic_age, visceral_fat_rating=visceral_fat_rating, bmi=bmi)
+        if self.can_compress(fit_timestamp):
+            self.write_message('weight_scale', fields=field_names[1:], compressed_timestamp=fit_timestamp, **values)
+            self.compressed_run += 1
+        else:
+            self.write_message('weight_scale', fields=field_names, timestamp=fit_timestamp, **values)
+            self.compressed_run = 0
+
+    @staticmethod
+    def weight_scale_fields(fields):
+        """tuple with timestamp followed by the selected fields in schema order"""
+        schema = MESSAGE_SCHEMAS['weight_scale']
+        if fields is None:
+            return schema.field_names
+        return ('timestamp',) + tuple(x for x in schema.field_names[1:] if x in fields)
+
+    def can_compress(self, fit_timestamp):
+        """check if a record can use a compressed timestamp header instead of a timestamp field"""
+        if not self.compressed_timestamps or self.last_timestamp is None:
+            return False
+        if self.compressed_run >= self.anchor_interval:
+            return False
+        return 0 <= fit_timestamp - self.last_timestamp <= self.MAX_TIME_OFFSET
+
+
+class FitEncoderTemplate(object):
+    """prebuilt start of a weight scale file, for writing many small files
+
+    the header, file_id and file_creator messages and the weight_scale definition are encoded once,
+    encoder() copies these bytes and the local message type state into a new FitEncoderWeight and
+    only patches time_created. Use get() to share templates between files"""
+
+    def __init__(self, compressed_timestamps=False, anchor_interval=32, fields=None):
+        self.compressed_timestamps = compressed_timestamps
+        self.anchor_interval = anchor_interval
+        self.fields = fields
+        encoder = FitEncoderWeight(compressed_timestamps=compressed_timestamps, anchor_interval=anchor_interval,
+                                   fields=fields)
+        file_id = MESSAGE_SCHEMAS['file_id'].compile()
+        # the file_id record follows its definition and a one byte record header
+        self.time_created_offset = (encoder.get_size() + 1 + len(file_id.definition) + 1 +
+                                    file_id.field_offset('time_created'))
+        encoder.write_message('file_id', time_created=0, type=encoder.FILE_TYPE)
+        encoder.write_file_creator()
+        # the first record has no previous timestamp, so it always uses the full weight_scale definition
+        encoder.define(MESSAGE_SCHEMAS['weight_scale'].compile(encoder.weight_scale_fields(fields)))
+        self.data = encoder.getvalue()
+        self.local_types = encoder.local_types
+        self.local_type_owners = encoder.local_type_owners
+        self.local_type_used = encoder.local_type_used
+        self.messages_written = encoder.messages_written
+
+    @classmethod
+    def get(cls, compressed_timestamps=False, anchor_interval=32, fields=None):
+        """return the cached template for a set of encoder options"""
+        key = (compressed_timestamps, anchor_interval, None if fields is None else tuple(fields))
+        template = _TEMPLATES.get(key)
+        if template is None:
+            template = _TEMPLATES[key] = cls(compressed_timestamps, anchor_interval, fields)
+        return template
+
+    def encoder(self, time_created=None):
+        """return a FitEncoderWeight positioned after the file_creator message"""
+        if time_created is None:
+            time_created = datetime.now()
+        encoder = FitEncoderWeight(compressed_timestamps=self.compressed_timestamps,
+                                   anchor_interval=self.anchor_interval, fields=self.fields)
+        encoder.buf = BytesIO(self.data)
+        encoder.buf.seek(0, 2)
+        with encoder.buf.getbuffer() as view:
+            pack_into('<I', view, self.time_created_offset, int(encoder.timestamp(time_created)))
+        encoder.local_types = dict(self.local_types)
+        encoder.local_type_owners = dict(self.local_type_owners)
+        encoder.local_type_used = dict(self.local_type_used)
+        encoder.messages_written = self.messages_written
+        return encoder
+
+
+_TEMPLATES = {}  # (compressed_timestamps, anchor_interval, fields) -> FitEncoderTemplate
+
+
+class FitAppender(FitEncoderWeight):
+    """encode records that continue an existing FIT file
+
+    the existing file is checked and scanned once for the local message types it defines and the
+    last timestamp, so new records reuse its definitions and compressed timestamp state. Only the
+    new records are held in the buffer, after finish() the file is updated by writing header at
+    offset 0 and getvalue() at offset existing_size, replacing the old crc"""
+
+    def __init__(self, data, compressed_timestamps=False, anchor_interval=32, fields=None):
+        super().__init__(compressed_timestamps=compressed_timestamps, anchor_interval=anchor_interval,
+                         fields=fields)
+        view = memoryview(data)
+        if len(view) < Fit.HEADER_SIZE + 2:
+            raise FitError('File is too short to be a FIT file')
+        self.header_size = view[0]
+        data_size = unpack_from('<I', view, 4)[0]
+        if self.header_size not in (12, 14) or bytes(view[8:12]) != b'.FIT':
+            raise FitError('Invalid FIT file header')
+        self.existing_size = self.header_size + data_size
+        if self.existing_size + 2 != len(view):
+            raise FitError('Header data size %d does not match file size %d' % (data_size, len(view)))
+        self.old_header = bytes(view[:self.header_size])
+        self.existing_data_size = data_size
+        # crc of the existing data from a zero state, combined with the header crc in finish
+        self.data_crc = crc16(view[self.header_size:self.existing_size])
+        crc = crc16_shift(crc16(self.old_header), data_size) ^ self.data_crc
+        if crc != unpack_from('<H', view, self.existing_size)[0]:
+            raise FitError('CRC mismatch')
+        self.header = None
+        self.restore_definitions(view[self.header_size:self.existing_size])
+        self.existing_messages = self.messages_written
+
+    def restore_definitions(self, view):
+        """scan the records of the existing data, defining the local message types that match a
+        compiled message and restoring the last timestamp"""
+        definitions = {}  # local message type -> (raw definition, record size, timestamp offset, endian)
+        last_timestamp = None
+        pos = 0
+        end = len(view)
+        while pos < end:
+            header = view[pos]
+            pos += 1
+            if header & 0x80:
+                lmsg_type = (header >> 5) & 0x3
+                last_timestamp = last_timestamp or 0
+                last_timestamp += ((header & 0x1F) - last_timestamp) & 0x1F
+            elif header & 0x40:
+                start = pos
+                num_fields = view[pos + 4]
+                pos += 5
+                size = 0
+                timestamp_offset = None
+                for i in range(num_fields):
+                    if view[pos] == 253 and view[pos + 1] == 4:
+                        timestamp_offset = size
+                    size += view[pos + 1]
+                    pos += 3
+                raw = bytes(view[start:pos])
+                if header & 0x20:
+                    num_dev_fields = view[pos]
+                    pos += 1
+                    for i in range(num_dev_fields):
+                        size += view[pos + 1]
+                        pos += 3
+                    raw = None
+                endian = '>' if raw is not None and raw[1] else '<'
+                definitions[header & 0x0F] = (raw, size, timestamp_offset, endian)
+                continue
+            else:
+                lmsg_type = header & 0x0F
+            if lmsg_type not in definitions:
+                raise FitError('Record at offset %d uses undefined local message type %d'
+                               % (self.header_size + pos - 1, lmsg_type))
+            raw, size, timestamp_offset, endian = definitions[lmsg_type]
+            if pos + size > end:
+                raise FitError('Record at offset %d is truncated' % (self.header_size + pos - 1))
+            if timestamp_offset is not None and not header & 0x80:
+                last_timestamp = unpack_from(endian + 'I', view, pos + timestamp_offset)[0]
+            self.local_type_used[lmsg_type] = self.messages_written
+            self.messages_written += 1
+            pos += size
+        self.last_timestamp = last_timestamp
+        for lmsg_type, (raw, _, _, _) in definitions.items():
+            compiled = self.match_definition(raw)
+            if compiled is not None:
+                self.local_types[compiled] = lmsg_type
+            # types with other definitions are taken so they are redefined before use
+            self.local_type_owners[lmsg_type] = compiled
+            self.local_type_used.setdefault(lmsg_type, -1)
+
+    @staticmethod
+    def match_definition(raw):
+        """return the compiled message with exactly this definition content, or None"""
+        if raw is None or raw[1] != 0:
+            return None
+        msg_number = unpack_from('<H', raw, 2)[0]
+        schema = next((x for x in MESSAGE_SCHEMAS.values() if x.msg_number == msg_number), None)
+        if schema is None:
+            return None
+        names = {num: name for name, num, _, _ in schema.fields}
+        nums = [raw[5 + 3 * i] for i in range(raw[4])]
+        if any(x not in names for x in nums):
+            return None
+        try:
+            compiled = schema.compile([names[x] for x in nums])
+        except ValueError:
+            return None
+        return compiled if compiled.definition == raw else None
+
+    def write_header(self, *args, **kwargs):
+        """the header of the existing file is rewritten by finish"""
+
+    def get_size(self):
+        return self.existing_size + len(self.buf.getbuffer())
+
+    def finish(self):
+        """build the updated header and append the crc of the whole file to the new records"""
+        data_size = self.existing_data_size + len(self.buf.getbuffer())
+        header = self.old_header[:4] + pack('<I', data_size) + self.old_header[8:12]
+        if self.header_size == 14:
+            header += pack('<H', crc16(header))
+        self.header = header
+        crc = crc16_shift(crc16(header), self.existing_data_size) ^ self.data_crc
+        with self.buf.getbuffer() as view:
+            crc = crc16(view, crc)
+        self.buf.seek(0, 2)
+        self.buf.write(pack('<H', crc))
+        METRICS.count('fit_messages_encoded', self.messages_written - self.existing_messages)
+        METRICS.count('fit_bytes_encoded', len(self.buf.getbuffer()))
+
+
+class FitChecksum(object):
+    """order independent checksum over the valid field values of the records of one message"""
+    MASK = (1 << 64) - 1
+
+    def __init__(self, name):
+        self.schema = MESSAGE_SCHEMAS[name]
+        self.msg_number = self.schema.msg_number
+        self.converters = {x[0]: (x[1], x[2], x[3]) for x in self.schema.fields}
+        self.records = 0
+        self.value = 0
+
+    def add_field(self, num, value):
+        self.value = (self.value + ((num << 32) ^ value)) & self.MASK
+
+    def add(self, values):
+        """add a record from a dict of unscaled values, as passed to FitEncoder.write_message"""
+        self.records += 1
+        for name, value in values.items():
+            if value is None or name not in self.converters:
+                continue
+            num, basetype, scale = self.converters[name]
+            if basetype['#'] not in _INT_TYPES:
+                continue
+            if scale is not None and scale != 1:
+                value *= scale
+            value = int(value)
+            if value != basetype['invalid']:
+                self.add_field(num, value)
+
+    def __eq__(self, other):
+        return (self.msg_number, self.records, self.value) == (other.msg_number, other.records, other.value)
+
+    def __repr__(self):
+        return 'FitChecksum(%s, records=%d, value=%016x)' % (self.schema.name, self.records, self.value)
+
+
+def read_fit_checksum(data, name='weight_scale'):
+    """validate the header, size and crc of a FIT file and compute the checksum of a message
+
+    records are decoded in place with struct.unpack_from, only integer fields are included
+    in the checksum. Raises FitError if the file is malformed"""
+    view = memoryview(data)
+    if len(view) < Fit.HEADER_SIZE + 2:
+        raise FitError('File is too short to be a FIT file')
+    header_size = view[0]
+    data_size = unpack_from('<I', view, 4)[0]
+    if header_size not in (12, 14) or bytes(view[8:12]) != b'.FIT':
+        raise FitError('Invalid FIT file header')
+    end = header_size + data_size
+    if end + 2 != len(view):
+        raise FitError('Header data size %d does not match file size %d' % (data_size, len(view)))
+    if crc16(view[:end]) != unpack_from('<H', view, end)[0]:
+        raise FitError('CRC mismatch')
+
+    checksum = FitChecksum(name)
+    target = checksum.msg_number
+    add_field = checksum.add_field
+    definitions = {}  # local message type -> (global message number, struct, field numbers, timestamp index)
+    last_timestamp = 0
+    pos = header_size
+    while pos < end:
+        header = view[pos]
+        pos += 1
+        compressed = None
+        if header & 0x80:
+            lmsg_type = (header >> 5) & 0x3
+            offset = header & 0x1F
+            last_timestamp += (offset - last_timestamp) & 0x1F
+            compressed = last_timestamp
+        elif header & 0x40:
+            endian = '>' if view[pos + 1] else '<'
+            msg_number = unpack_from(endian + 'H', view, pos + 2)[0]
+            num_fields = view[pos + 4]
+            pos += 5
+            fmt = [endian]
+            fields = []
+            for i in range(num_fields):
+                num, size, base = view[pos], view[pos + 1], view[pos + 2]
+                pos += 3
+                basetype = _BASE_TYPES.get(base & 0x1F)
+                field_fmt = FitBaseType.get_format(basetype) if basetype is not None else 's'
+                if field_fmt in 'sc' or calcsize('<' + field_fmt) != size:
+                    field_fmt = '%ds' % size
+                    basetype = None
+                elif basetype['#'] not in _INT_TYPES:
+                    basetype = None
+                fmt.append(field_fmt)
+                fields.append((num, basetype['invalid'] if basetype is not None else None))
+            if header & 0x20:
+                # developer fields are skipped as opaque bytes
+                num_dev_fields = view[pos]
+                pos += 1
+                for i in range(num_dev_fields):
+                    fmt.append('%dx' % view[pos + 1])
+                    pos += 3
+            nums = [x[0] for x in fields]
+            timestamp_index = nums.index(253) if 253 in nums else None
+            definitions[header & 0x0F] = (msg_number, Struct(''.join(fmt)), fields, timestamp_index)
+            continue
+        else:
+            lmsg_type = header & 0x0F
+        if lmsg_type not in definitions:
+            raise FitError('Record at offset %d uses undefined local message type %d' % (pos - 1, lmsg_type))
+        msg_number, record_struct, fields, timestamp_index = definitions[lmsg_type]
+        if pos + record_struct.size > end:
+            raise FitError('Record at offset %d is truncated' % (pos - 1))
+        values = record_struct.unpack_from(view, pos)
+        pos += record_struct.size
+        if timestamp_index is not None:
+            last_timestamp = values[timestamp_index]
+        if msg_number != target:
+            continue
+        checksum.records += 1
+        if compressed is not None:
+            add_field(253, compressed)
+        for (num, invalid), value in zip(fields, values):
+            if invalid is not None and value != invalid:
+                add_field(num, value)
+    return checksum
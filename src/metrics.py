@@ -0,0 +1,153 @@
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Iterable, Iterator
+
+try:
+  import resource
+except ImportError:  # not available on Windows
+  resource = None
+
+PROMETHEUS_PREFIX = "eufyformatter_"
+
+
+class Metrics:
+  """
+  Counters and stage durations of a run
+
+  Time is attributed to one stage at a time: entering a stage pauses the
+  stage that was active, so durations of nested stages do not overlap.
+  Stages must only be entered from one thread, counters can be updated from any thread.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.counters = {}
+    self.durations = {}
+    self.started = time.time()
+    self._stages = []
+    self._mark = 0.0
+
+  def reset(self) -> None:
+    self.__init__()
+
+  def count(self, name: str, value: float = 1) -> None:
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def set(self, name: str, value: float) -> None:
+    with self._lock:
+      self.counters[name] = value
+
+  def _switch(self) -> None:
+    now = time.perf_counter()
+    if self._stages:
+      stage = self._stages[-1]
+      self.durations[stage] = self.durations.get(stage, 0.0) + now - self._mark
+    self._mark = now
+
+  def enter(self, stage: str) -> None:
+    self._switch()
+    self._stages.append(stage)
+
+  def leave(self) -> None:
+    self._switch()
+    self._stages.pop()
+
+  @contextlib.contextmanager
+  def stage(self, name: str) -> Iterator[None]:
+    """
+    Attribute the time spent in a with block to a stage
+    """
+    self.enter(name)
+    try:
+      yield
+    finally:
+      self.leave()
+
+  def timed(self, entries: Iterable, stage: str) -> Iterator:
+    """
+    Attribute the time spent producing the items of an iterable to a stage
+
+    :param entries: iterable to wrap
+    :param stage: name of stage
+    :return: iterator over the same items
+    """
+    entries = iter(entries)
+    while True:
+      self.enter(stage)
+      try:
+        entry = next(entries)
+      except StopIteration:
+        return
+      finally:
+        self.leave()
+      yield entry
+
+  def snapshot(self) -> dict:
+    """
+    :return: dict with the counters, stage durations in seconds, peak rss in bytes and the start time of the run
+    """
+    with self._lock:
+      values = dict(self.counters)
+    values["stage_seconds"] = {x: round(y, 6) for x, y in self.durations.items()}
+    values["peak_rss_bytes"] = peak_rss()
+    values["duration_seconds"] = round(time.time() - self.started, 6)
+    values["start_time_seconds"] = int(self.started)
+    return values
+
+  def to_json(self) -> str:
+    return json.dumps(self.snapshot(), indent=2)
+
+  def to_prometheus(self) -> str:
+    """
+    Format the metrics for the Prometheus node exporter textfile collector
+
+    :return: text with one gauge per counter and a labelled gauge for stage durations
+    """
+    values = self.snapshot()
+    lines = []
+    stages = values.pop("stage_seconds")
+    for name, value in values.items():
+      if value is None:
+        continue
+      lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name} gauge")
+      lines.append(f"{PROMETHEUS_PREFIX}{name} {value}")
+    if stages:
+      lines.append(f"# TYPE {PROMETHEUS_PREFIX}stage_seconds gauge")
+      lines.extend(f'{PROMETHEUS_PREFIX}stage_seconds{{stage="{stage}"}} {seconds}'
+                   for stage, seconds in stages.items())
+    return "\n".join(lines) + "\n"
+
+  def write(self, filename: str) -> None:
+    """
+    Write the metrics to a file, as json for .json files and in Prometheus text format otherwise.
+    The file is replaced atomically so collectors never read a partial file
+
+    :param filename: name of file to write
+    :return: None
+    """
+    text = self.to_json() if filename.lower().endswith(".json") else self.to_prometheus()
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False, encoding="utf-8") as f:
+      f.write(text)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, filename)
+
+
+def peak_rss() -> int | None:
+  """
+  :return: peak resident set size of the process in bytes, None if it cannot be determined
+  """
+  if resource is None:
+    return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+  return rss if sys.platform == "darwin" else rss * 1024
+
+
+METRICS = Metrics()
@@ -0,0 +1,147 @@
+import queue
+import threading
+from itertools import islice
+from typing import Iterable, Iterator
+
+from sinks import abort_sinks
+
+DEFAULT_BATCH_SIZE = 1024  # entries passed between stages at a time
+DEFAULT_QUEUE_SIZE = 4  # batches a stage can run ahead of the next one
+POLL_INTERVAL = 0.1  # seconds between checks whether the other stage has stopped
+
+_END = object()
+
+
+class _Failure:
+  """
+  Exception raised in a stage, passed on so it is raised in the calling thread
+  """
+
+  def __init__(self, error: BaseException):
+    self.error = error
+
+
+def _put(batches: queue.Queue, item, stop: threading.Event) -> bool:
+  """
+  Put an item in a bounded queue, waiting while the queue is full unless the pipeline is stopped
+
+  :return: True if the item was queued
+  """
+  while not stop.is_set():
+    try:
+      batches.put(item, timeout=POLL_INTERVAL)
+      return True
+    except queue.Full:
+      continue
+  return False
+
+
+def _get(batches: queue.Queue, stop: threading.Event):
+  """
+  Get an item from a queue, returns the end marker if the pipeline is stopped
+  """
+  while not stop.is_set():
+    try:
+      return batches.get(timeout=POLL_INTERVAL)
+    except queue.Empty:
+      continue
+  return _END
+
+
+def _send_batches(entries: Iterable, batches: queue.Queue, batch_size: int, stop: threading.Event) -> None:
+  entries = iter(entries)
+  while batch := list(islice(entries, batch_size)):
+    if not _put(batches, batch, stop):
+      return
+  _put(batches, _END, stop)
+
+
+def threaded(entries: Iterable, batch_size: int = DEFAULT_BATCH_SIZE,
+             queue_size: int = DEFAULT_QUEUE_SIZE) -> Iterator:
+  """
+  Run an iterable, e.g. a file reader, on a background thread
+
+  Entries are passed to the caller in batches through a bounded queue, so the
+  reader stops when it is queue_size batches ahead.  Exceptions, including
+  SystemExit, are raised in the calling thread.
+
+  :param entries: iterable producing entries
+  :param batch_size: number of entries in a batch
+  :param queue_size: maximum number of batches waiting in the queue
+  :return: iterator over the entries
+  """
+  batches = queue.Queue(queue_size)
+  stop = threading.Event()
+
+  def produce() -> None:
+    try:
+      _send_batches(entries, batches, batch_size, stop)
+    except BaseException as e:
+      _put(batches, _Failure(e), stop)
+
+  thread = threading.Thread(target=produce, name="reader", daemon=True)
+  thread.start()
+  try:
+    while True:
+      batch = batches.get()
+      if batch is _END:
+        return
+      if isinstance(batch, _Failure):
+        raise batch.error
+      yield from batch
+  finally:
+    stop.set()
+    thread.join()
+
+
+def write_sinks_threaded(entries: Iterable, sinks: list, batch_size: int = DEFAULT_BATCH_SIZE,
+                         queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+  """
+  Write entries to several sinks on a background thread
+
+  The calling thread produces entries, e.g. filtering and sorting them, while
+  the writer thread encodes and writes them.  Entries are passed in batches
+  through a bounded queue so the producer waits when the writer falls behind.
+
+  :param entries: iterable of WeightEntry objects
+  :param sinks: list of sinks to write to
+  :param batch_size: number of entries in a batch
+  :param queue_size: maximum number of batches waiting in the queue
+  :return: None
+  """
+  batches = queue.Queue(queue_size)
+  stop = threading.Event()
+  errors = []
+
+  def consume() -> None:
+    opened = []
+    try:
+      for sink in sinks:
+        sink.open()
+        opened.append(sink)
+      while (batch := _get(batches, stop)) is not _END:
+        for entry in batch:
+          for sink in sinks:
+            sink.write(entry)
+      if not stop.is_set():
+        while opened:
+          opened[0].close()
+          opened.pop(0)
+    except BaseException as e:
+      errors.append(e)
+      stop.set()
+    finally:
+      # the producer failed or a sink raised, partial outputs are removed
+      abort_sinks(opened)
+
+  thread = threading.Thread(target=consume, name="writer", daemon=True)
+  thread.start()
+  try:
+    _send_batches(entries, batches, batch_size, stop)
+  except BaseException:
+    stop.set()
+    raise
+  finally:
+    thread.join()
+  if errors:
+    raise errors[0]
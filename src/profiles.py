@@ -0,0 +1,325 @@
+import dataclasses
+import datetime
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Callable
+
+from entries import WeightEntry
+from sinks import FIT_LIMITS
+
+LB_TO_KG_FACTOR = 0.45359237
+DEFAULT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# conversion factors to kg for mass columns
+UNIT_FACTORS = {
+  "kg": 1.0,
+  "g": 0.001,
+  "lbs": LB_TO_KG_FACTOR,
+  "lb": LB_TO_KG_FACTOR,
+  "st": 6.35029318,
+}
+
+# WeightEntry fields that are kept as text instead of being converted to numbers
+TEXT_FIELDS = {"body_type", "family_member"}
+
+
+class RangeError(ValueError):
+  """
+  Value that can be converted but does not fit the FIT field it is written to
+  """
+
+
+@dataclass
+class SourceProfile:
+  """
+  Declarative description of a csv export, mapping column names to a
+  WeightEntry field and an optional unit
+  """
+  name: str
+  columns: dict[str, tuple[str | None, str | None]]  # column -> (field or None to ignore, unit)
+  time_format: str = DEFAULT_TIME_FORMAT
+
+  def __post_init__(self):
+    for target, unit in self.columns.values():
+      if target is not None:
+        make_converter(target, unit, self.time_format)  # raises ValueError for unknown units
+
+  def matches(self, header: list[str]) -> bool:
+    """
+    Check whether every column in a header is known to this profile
+
+    :param header: list of column names
+    :return: True if the profile can decode rows with this header
+    """
+    return all(column in self.columns for column in header)
+
+  def compile(self, header: list[str]) -> "RowDecoder":
+    """
+    Compile a decoder for rows with the given header
+
+    :param header: list of column names
+    :return: RowDecoder for the header
+    """
+    return RowDecoder(self, header)
+
+
+@dataclass
+class RowDecoder:
+  """
+  Decoder turning a csv row into WeightEntry keyword arguments, built once per header
+  """
+  profile: SourceProfile
+  header: list[str]
+  fields: tuple[str, ...] = field(init=False)
+  steps: list[tuple[int, str, Callable]] = field(init=False)
+
+  def __post_init__(self):
+    self.steps = []
+    for index, column in enumerate(self.header):
+      target, unit = self.profile.columns[column]
+      if target is None:
+        continue
+      self.steps.append((index, target, make_converter(target, unit, self.profile.time_format)))
+    self.fields = tuple(step[1] for step in self.steps)
+    if "time" not in self.fields:
+      raise ValueError(f"Profile {self.profile.name} does not provide a time column")
+
+  def __call__(self, row: list[str]) -> dict:
+    """
+    Decode a row
+
+    :param row: list of values from a csv row
+    :return: dict mapping WeightEntry fields to converted values
+    """
+    return {target: convert(row[index]) for index, target, convert in self.steps}
+
+  def diagnose(self, row: list[str]) -> tuple[str, str]:
+    """
+    Find out why a row could not be decoded
+
+    :param row: list of values from a csv row
+    :return: tuple with the kind of problem and a description
+    """
+    if len(row) < len(self.header):
+      return "missing values", f"expected {len(self.header)} values, found {len(row)}"
+    for index, target, convert in self.steps:
+      try:
+        convert(row[index])
+      except RangeError as e:
+        return "out of range", f"column {self.header[index]}: {row[index]!r}, {e}"
+      except (ValueError, TypeError):
+        return "invalid value", f"column {self.header[index]}: {row[index]!r}"
+    return "invalid row", ""
+
+
+def make_converter(target: str, unit: str | None, time_format: str) -> Callable:
+  """
+  Create a function converting a csv value to the value stored in a WeightEntry
+
+  :param target: WeightEntry field the value is stored in
+  :param unit: unit of the csv value, mass units are converted to kg
+  :param time_format: strptime format used for the time column
+  :return: conversion function, numbers that do not fit their FIT field raise RangeError
+  """
+  if target == "time":
+    if time_format == DEFAULT_TIME_FORMAT:
+      return parse_default_time
+    return lambda val: datetime.datetime.strptime(val, time_format)
+  if target == "family_member":
+    return str.strip
+  if target in TEXT_FIELDS:
+    return str
+  if unit is not None and unit not in UNIT_FACTORS:
+    raise ValueError(f"Unknown unit {unit} for field {target}")
+  factor = UNIT_FACTORS[unit] if unit is not None else 1.0
+  if factor == 1.0:
+    convert = float
+  else:
+    convert = lambda val: round(float(val) * factor, 1)
+  if target not in FIT_LIMITS:
+    return convert
+  low, high = FIT_LIMITS[target]
+
+  def convert_in_range(val: str) -> float:
+    value = convert(val)
+    if not low <= value <= high:
+      raise RangeError(f"{target} must be between {low:g} and {high:g}")
+    return value
+  return convert_in_range
+
+
+def parse_default_time(val: str) -> datetime.datetime:
+  """
+  Parse a time in DEFAULT_TIME_FORMAT, values in exactly that layout take the faster
+  fromisoformat, anything else goes through strptime so that date only values and
+  values with a timezone are rejected as before
+
+  :param val: csv value
+  :return: naive datetime
+  :raises ValueError: if the value does not match DEFAULT_TIME_FORMAT
+  """
+  if len(val) == 19 and val[4] == val[7] == "-" and val[10] == " " and val[13] == val[16] == ":":
+    return datetime.datetime.fromisoformat(val)
+  return datetime.datetime.strptime(val, DEFAULT_TIME_FORMAT)
+
+
+EUFY_PROFILE = SourceProfile(
+  name="eufy",
+  columns={
+    "Time": ("time", None),
+    "Family Members": ("family_member", None),
+    "WEIGHT (kg)": ("weight", "kg"),
+    "WEIGHT (lbs)": ("weight", "lbs"),
+    "BMI": ("bmi", None),
+    "BODY FAT %": ("body_fat", None),
+    "HEART RATE (bpm)": ("heart_rate", None),
+    "MUSCLE MASS (kg)": ("muscle_mass", "kg"),
+    "MUSCLE MASS (lbs)": ("muscle_mass", "lbs"),
+    "MUSCLE MASS %": ("muscle_mass_percent", None),
+    "BMR": ("bmr", None),
+    "WATER": ("water", None),
+    "BODY FAT MASS (kg)": ("body_fat_mass", "kg"),
+    "BODY FAT MASS (lbs)": ("body_fat_mass", "lbs"),
+    "LEAN BODY MASS (kg)": ("lean_body_mass", "kg"),
+    "LEAN BODY MASS (lbs)": ("lean_body_mass", "lbs"),
+    "BONE MASS (kg)": ("bone_mass", "kg"),
+    "BONE MASS (lbs)": ("bone_mass", "lbs"),
+    "BONE MASS %": ("bone_mass_percentage", None),
+    "VISCERAL FAT": ("visceral_fat_percentage", None),
+    "PROTEIN %": ("protein_percentage", None),
+    "SKELETAL MUSCLE MASS (kg)": ("skeletal_muscle_mass", "kg"),
+    "SKELETAL MUSCLE MASS (lbs)": ("skeletal_muscle_mass", "lbs"),
+    "SUBCUTANEOUS FAT %": ("subcutaneous_fat_percentage", None),
+    "BODY AGE": ("body_age", None),
+    "BODY TYPE": ("body_type", None),
+    "HEAD SIZE (cm)": ("head_size", None),
+  })
+
+# profiles are tried in order, user supplied profiles are inserted in front of the eufy profile
+PROFILES: list[SourceProfile] = [EUFY_PROFILE]
+_decoder_cache: dict[str, RowDecoder] = {}
+
+
+def register_profile(profile: SourceProfile) -> None:
+  """
+  Register a profile so that it is considered when detecting the source of a file
+
+  :param profile: profile to register
+  :return: None
+  """
+  PROFILES.insert(0, profile)
+  _decoder_cache.clear()
+
+
+def unregister_profile(profile: SourceProfile) -> None:
+  """
+  Remove a previously registered profile
+
+  :param profile: profile to remove
+  :return: None
+  """
+  PROFILES.remove(profile)
+  _decoder_cache.clear()
+
+
+def load_profile(filename: str) -> SourceProfile:
+  """
+  Load a profile from a json file with the following layout:
+
+    {"name": "scale", "time_format": "%d/%m/%Y %H:%M",
+     "columns": {"Date": {"field": "time"}, "Weight (lb)": {"field": "weight", "unit": "lbs"}}}
+
+  Columns that are null or have a null field are ignored.
+
+  :param filename: name of json file to load
+  :return: SourceProfile
+  :raises ValueError: if a column has no field or an unknown field or unit
+  """
+  entry_fields = {x.name for x in dataclasses.fields(WeightEntry)}
+  with open(filename, "r", encoding="utf-8") as profile_file:
+    data = json.load(profile_file)
+  columns = {}
+  for column, spec in data["columns"].items():
+    if spec is None:
+      columns[column] = (None, None)
+      continue
+    if not isinstance(spec, dict) or "field" not in spec:
+      raise ValueError(f"Column {column} has no field, use null to ignore it")
+    target, unit = spec["field"], spec.get("unit")
+    if target is not None and target not in entry_fields:
+      raise ValueError(f"Unknown field {target} for column {column}")
+    if unit is not None and unit not in UNIT_FACTORS:
+      raise ValueError(f"Unknown unit {unit} for column {column}")
+    columns[column] = (target, unit)
+  return SourceProfile(name=data.get("name", filename),
+                       columns=columns,
+                       time_format=data.get("time_format", DEFAULT_TIME_FORMAT))
+
+
+def header_fingerprint(header: list[str]) -> str:
+  """
+  Compute a fingerprint identifying a csv header
+
+  :param header: list of column names
+  :return: hex digest of the header
+  """
+  return hashlib.blake2b("\x1f".join(header).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def lookup_field(column: str) -> str | None:
+  """
+  Find the WeightEntry field for a column name in the registered profiles
+
+  :param column: column name
+  :return: field name or None if the column is unknown or ignored
+  """
+  for profile in PROFILES:
+    if column in profile.columns:
+      return profile.columns[column][0]
+  return None
+
+
+def get_partial_decoder(header: list[str]) -> tuple[RowDecoder | None, list[str]]:
+  """
+  Select the profile that knows most columns of a header, unknown columns are ignored
+
+  :param header: list of column names
+  :return: tuple with RowDecoder, or None if no profile knows the time column, and list of unknown columns
+  """
+  decoder = get_decoder(header)
+  if decoder is not None:
+    return decoder, []
+  best, best_known = None, 0
+  for profile in PROFILES:
+    known = [x for x in header if x in profile.columns]
+    if len(known) > best_known and any(profile.columns[x][0] == "time" for x in known):
+      best, best_known = profile, len(known)
+  if best is None:
+    return None, list(header)
+  unknown = [x for x in header if x not in best.columns]
+  partial = SourceProfile(name=best.name,
+                          columns={**best.columns, **{x: (None, None) for x in unknown}},
+                          time_format=best.time_format)
+  return partial.compile(header), unknown
+
+
+def get_decoder(header: list[str]) -> RowDecoder | None:
+  """
+  Select a profile matching a header and return a compiled decoder for it,
+  decoders are cached by header fingerprint
+
+  :param header: list of column names
+  :return: RowDecoder or None if no profile matches the header or it has no time column
+  """
+  fingerprint = header_fingerprint(header)
+  decoder = _decoder_cache.get(fingerprint)
+  if decoder is not None:
+    return decoder
+  for profile in PROFILES:
+    # a header without the time column cannot be decoded, leave it unrecognized
+    if profile.matches(header) and any(profile.columns[x][0] == "time" for x in header):
+      decoder = profile.compile(header)
+      _decoder_cache[fingerprint] = decoder
+      return decoder
+  return None
@@ -0,0 +1,71 @@
+import csv
+from collections import Counter
+
+
+class Quarantine:
+  """
+  Collects csv rows that could not be converted, optionally writing them
+  with their line number and the reason to a csv file
+  """
+
+  def __init__(self, filename: str = None):
+    """
+    :param filename: name of csv file to write rejected rows to, None to only count them
+    """
+    self.filename = filename
+    self.header = []
+    self.count = 0
+    self.reasons = Counter()
+    self.unknown_columns = []
+    self._file = None
+    self._writer = None
+
+  def set_header(self, header: list[str], unknown_columns: list[str] = None) -> None:
+    """
+    Set the header of the file being read
+
+    :param header: list of column names
+    :param unknown_columns: columns that are ignored because no profile knows them
+    :return: None
+    """
+    self.header = header
+    self.unknown_columns = unknown_columns or []
+
+  def add(self, line: int, kind: str, detail: str, row: list[str]) -> None:
+    """
+    Record a rejected row
+
+    :param line: line number of the row in the csv file
+    :param kind: short category of the problem, used to count problems
+    :param detail: description of the problem
+    :param row: values of the row
+    :return: None
+    """
+    self.count += 1
+    self.reasons[kind] += 1
+    if self.filename is None:
+      return
+    if self._writer is None:
+      self._file = open(self.filename, "w", encoding="utf-8", newline="")
+      self._writer = csv.writer(self._file)
+      self._writer.writerow(["line", "reason"] + self.header)
+    self._writer.writerow([line, f"{kind}: {detail}" if detail else kind] + row)
+
+  def close(self) -> None:
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def summary(self) -> str:
+    """
+    Describe the rejected rows and ignored columns
+
+    :return: summary text
+    """
+    lines = [f"Skipped {self.count} rows"]
+    lines.extend(f"  {kind}: {count}" for kind, count in self.reasons.most_common())
+    if self.unknown_columns:
+      lines.append(f"Ignored unknown columns: {', '.join(self.unknown_columns)}")
+    if self.count and self.filename is not None:
+      lines.append(f"Rejected rows written to {self.filename}")
+    return "\n".join(lines)
@@ -0,0 +1,117 @@
+import csv
+import mmap
+import os
+from typing import Iterable, Iterator
+
+BOM = b"\xef\xbb\xbf"
+# lines are split from the buffer in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_lines(data, start: int = 0, end: int = None) -> Iterator[bytes]:
+  """
+  Split a range of a bytes-like buffer into lines without the newline
+
+  :param data: bytes, mmap or other buffer supporting slicing
+  :param start: offset of the first byte of the range
+  :param end: offset after the last byte of the range, None for the end of the buffer
+  :return: iterator over lines, a trailing \\r is kept
+  """
+  end = len(data) if end is None else end
+  rest = b""
+  pos = start
+  while pos < end:
+    chunk = data[pos:min(pos + CHUNK_SIZE, end)]
+    pos += len(chunk)
+    lines = chunk.split(b"\n")
+    lines[0] = rest + lines[0]
+    rest = lines.pop()
+    yield from lines
+  if rest:
+    yield rest
+
+
+class RecordError(ValueError):
+  """
+  A record that is not valid utf-8 or csv, yielded by iter_records in place of the field values
+  """
+
+  def __init__(self, kind: str, detail: str, data: bytes):
+    super().__init__(f"{kind}: {detail}")
+    self.kind = kind
+    self.detail = detail
+    self.row = [data.decode("utf-8", "backslashreplace")]
+
+
+def _decode(line: bytes) -> str:
+  try:
+    return line.decode("utf-8")
+  except UnicodeDecodeError as e:
+    raise RecordError("invalid utf-8", f"byte {e.start}", line) from None
+
+
+def _opens_quote(line: bytes) -> bool:
+  """
+  Check if a field of a line starts with a quote, quotes inside unquoted fields are literal
+  """
+  return line.startswith(b'"') or b',"' in line
+
+
+def iter_records(lines: Iterable[bytes]) -> Iterator[tuple[int, list[str] | RecordError]]:
+  """
+  Split lines into csv records, lines without quoted fields are decoded in one
+  call and split on commas, lines with a field starting with a quote are parsed
+  with the csv module and may continue on following lines
+
+  :param lines: iterable of lines without newlines
+  :return: iterator over (line number, list of field values) tuples, empty lines are skipped and
+           the line number is that of the last line of the record.  Records that are not valid
+           utf-8 or csv are returned as a RecordError instead of the field values
+  """
+  line_num = 0
+  lines = iter(lines)
+  for line in lines:
+    line_num += 1
+    if line.endswith(b"\r"):
+      line = line[:-1]
+    if not line:
+      continue
+    try:
+      if not _opens_quote(line):
+        yield line_num, _decode(line).split(",")
+        continue
+      record = [line]
+
+      def continued() -> Iterator[str]:
+        # the csv reader only asks for another line while a quoted field is open
+        yield _decode(record[0])
+        for more in lines:
+          record.append(more[:-1] if more.endswith(b"\r") else more)
+          yield "\n" + _decode(record[-1])
+
+      try:
+        row = next(csv.reader(continued()), [])
+      except csv.Error as e:
+        raise RecordError("invalid csv", str(e), b"\n".join(record)) from None
+      finally:
+        line_num += len(record) - 1
+    except RecordError as e:
+      yield line_num, e
+      continue
+    yield line_num, row
+
+
+def scan_file(filename: str) -> Iterator[tuple[int, list[str]]]:
+  """
+  Memory-map a csv file and split it into records, a utf-8 byte order mark is skipped
+
+  :param filename: name of csv file
+  :return: iterator over (line number, list of field values) tuples, starting with the header
+  """
+  with open(filename, "rb") as csv_file:
+    if os.fstat(csv_file.fileno()).st_size == 0:
+      return
+    with mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      start = len(BOM) if data[:len(BOM)] == BOM else 0
+      yield from iter_records(iter_lines(data, start))
+
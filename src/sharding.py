@@ -0,0 +1,123 @@
+import csv
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from profiles import SourceProfile, TEXT_FIELDS
+from scanner import RecordError, iter_lines, iter_records
+
+# shards smaller than this are not worth the cost of starting a worker process
+MIN_SHARD_SIZE = 4 * 1024 * 1024
+
+
+def read_header(filename: str) -> tuple[list[str], int]:
+  """
+  Read the header row of a csv file
+
+  :param filename: name of csv file
+  :return: tuple with list of column names and offset of the first data row
+  """
+  with open(filename, "rb") as csv_file:
+    line = csv_file.readline()
+    offset = csv_file.tell()
+  header = next(csv.reader([line.decode("utf-8-sig")]), [])
+  return header, offset
+
+
+def shard_ranges(filename: str, data_start: int, shards: int) -> list[tuple[int, int]]:
+  """
+  Split the data rows of a file into byte ranges that start and end on line boundaries
+
+  :param filename: name of csv file
+  :param data_start: offset of the first data row
+  :param shards: maximum number of ranges to create
+  :return: list of (start, end) offsets
+  """
+  size = os.path.getsize(filename)
+  shards = max(1, min(shards, (size - data_start) // MIN_SHARD_SIZE))
+  step = (size - data_start) // shards
+  boundaries = [data_start]
+  with open(filename, "rb") as csv_file:
+    for i in range(1, shards):
+      csv_file.seek(data_start + i * step)
+      csv_file.readline()  # move to the start of the next line
+      boundaries.append(max(csv_file.tell(), boundaries[-1]))
+  boundaries.append(size)
+  return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def parse_shard(filename: str, start: int, end: int,
+                profile: SourceProfile, header: list[str]) -> tuple[list, list, int]:
+  """
+  Parse the rows in a byte range of a csv file into columns
+
+  Numeric columns are returned as arrays of doubles so that they are cheap to
+  send back from a worker process.  Rows that cannot be decoded are returned
+  separately with their line number relative to the start of the range.
+
+  :param filename: name of csv file
+  :param start: offset of the first byte of the range
+  :param end: offset after the last byte of the range
+  :param profile: source profile used to decode rows
+  :param header: list of column names in the file
+  :return: tuple with list of columns in the order of the decoder fields,
+           list of (line, kind, detail, row) tuples for rejected rows and number of lines in the range
+  """
+  decoder = profile.compile(header)
+  columns = [[] if target == "time" or target in TEXT_FIELDS else array("d")
+             for target in decoder.fields]
+  errors = []
+  with open(filename, "rb") as csv_file:
+    csv_file.seek(start)
+    data = csv_file.read(end - start)
+  steps = decoder.steps
+  for line, row in iter_records(iter_lines(data)):
+    if isinstance(row, RecordError):
+      errors.append((line, row.kind, row.detail, row.row))
+      continue
+    try:
+      values = [convert(row[index]) for index, _, convert in steps]
+    except (ValueError, TypeError, IndexError):
+      errors.append((line, *decoder.diagnose(row), row))
+      continue
+    for column, value in zip(columns, values):
+      column.append(value)
+  return columns, errors, data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+
+
+def parse_sharded(filename: str, profile: SourceProfile, header: list[str],
+                  data_start: int, workers: int) -> tuple[list, list]:
+  """
+  Parse a csv file in parallel worker processes
+
+  :param filename: name of csv file
+  :param profile: source profile used to decode rows
+  :param header: list of column names in the file
+  :param data_start: offset of the first data row
+  :param workers: number of worker processes
+  :return: tuple with list of columns for the whole file in file order and list of
+           (line, kind, detail, row) tuples for rejected rows, line numbers count the header as line 1
+  """
+  ranges = shard_ranges(filename, data_start, workers)
+  if not ranges:
+    return [[] for _ in profile.compile(header).fields], []
+  if len(ranges) == 1:
+    results = [parse_shard(filename, ranges[0][0], ranges[0][1], profile, header)]
+  else:
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+      results = list(executor.map(parse_shard,
+                                  [filename] * len(ranges),
+                                  [r[0] for r in ranges],
+                                  [r[1] for r in ranges],
+                                  [profile] * len(ranges),
+                                  [header] * len(ranges)))
+  columns = results[0][0]
+  for result in results[1:]:
+    for column, part in zip(columns, result[0]):
+      column.extend(part)
+  errors = []
+  line_offset = 1
+  for _, shard_errors, lines in results:
+    errors.extend((line + line_offset, kind, detail, row) for line, kind, detail, row in shard_errors)
+    line_offset += lines
+  return columns, errors
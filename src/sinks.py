@@ -0,0 +1,341 @@
+import abc
+import csv
+import dataclasses
+import json
+import os
+import stat
+import tempfile
+from typing import IO, Iterable, Union
+
+from entries import WeightEntry
+from fit import FitAppender, FitChecksum, FitEncoderTemplate, FitError, field_limits, read_fit_checksum
+
+DEFAULT_FIT_FIELDS = ["time", "weight", "bmi", "body_fat", "muscle_mass", "bmr", "water", "bone_mass"]
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# WeightEntry fields that are written to the fit file and the weight_scale field they are stored in
+WEIGHT_SCALE_FIELDS = {
+  "weight": "weight",
+  "bmi": "bmi",
+  "body_fat": "percent_fat",
+  "muscle_mass": "muscle_mass",
+  "bmr": "basal_met",
+  "water": "percent_hydration",
+  "bone_mass": "bone_mass",
+  "body_age": "metabolic_age",
+  "visceral_fat_percentage": "visceral_fat_mass",
+}
+
+# lowest and highest value of the WeightEntry fields that can be stored in their FIT field
+FIT_LIMITS = {field: field_limits("weight_scale", fit_field) for field, fit_field in WEIGHT_SCALE_FIELDS.items()}
+FIT_LIMITS["heart_rate"] = field_limits("blood_pressure", "heart_rate")
+
+
+class Sink(abc.ABC):
+  """
+  Destination for converted entries, a sink is opened, receives entries one
+  at a time and is closed when all entries have been written
+  """
+
+  def __init__(self, output: Union[str, IO], fields: list[str] = None):
+    """
+    :param output: name of file to write, or a file object that is left open when the sink is closed
+    :param fields: list of WeightEntry fields to write, None for the sink default
+    """
+    self.output = output
+    self.filename = output if isinstance(output, str) else getattr(output, "name", None)
+    self.fields = fields
+    self.count = 0
+
+  def open(self) -> None:
+    pass
+
+  @abc.abstractmethod
+  def write(self, entry) -> None:
+    """
+    Write one entry
+
+    :param entry: WeightEntry to write
+    """
+
+  def close(self) -> None:
+    pass
+
+  def abort(self) -> None:
+    """
+    Stop writing after an error, an output file that was only partly written is removed
+    """
+    pass
+
+  def open_output(self, mode: str, **kwargs) -> IO:
+    """
+    Open the output of the sink
+
+    :param mode: mode used to open a file name
+    :param kwargs: other arguments to open
+    :return: file object to write to
+    """
+    if isinstance(self.output, str):
+      return open(self.output, mode, **kwargs)
+    return self.output
+
+  def close_output(self, file: IO) -> None:
+    if isinstance(self.output, str):
+      file.close()
+
+  def discard_output(self, file: IO) -> None:
+    """
+    Close and remove a partly written output file, file objects are left open
+    """
+    if isinstance(self.output, str):
+      file.close()
+      if os.path.exists(self.output):
+        os.remove(self.output)
+
+
+class FitSink(Sink):
+  """
+  Write weight_scale records to a FIT file that Garmin Connect can import
+  """
+
+  def __init__(self, output: Union[str, IO[bytes]], fields: list[str] = None,
+               compressed_timestamps: bool = False, verify: bool = False, append: bool = False):
+    """
+    :param output: name of file to write or binary file object
+    :param fields: list of WeightEntry fields to write, None for the default fields
+    :param compressed_timestamps: use compressed timestamp headers for records close together in time
+    :param verify: keep a checksum of the written values so the file can be checked with verify()
+    :param append: add entries after the last reading of an existing file, output must be a file name
+    """
+    if append and not isinstance(output, str):
+      raise ValueError("Only files given by name can be appended to")
+    super().__init__(output, DEFAULT_FIT_FIELDS if fields is None else fields)
+    self.compressed_timestamps = compressed_timestamps
+    # only selected fields with a weight_scale equivalent are defined in the fit file
+    self.fit_fields = [(x, WEIGHT_SCALE_FIELDS[x]) for x in self.fields if x in WEIGHT_SCALE_FIELDS]
+    # heart rate is written in a separate blood_pressure message
+    self.heart_rate = "heart_rate" in self.fields
+    self.checksum = FitChecksum("weight_scale") if verify else None
+    self.append = append
+    self.encoder = None
+    self.size = 0
+    self.skipped = 0  # entries not appended because the file already has later readings
+
+  def open(self) -> None:
+    fields = [x[1] for x in self.fit_fields]
+    if self.append and os.path.exists(self.output):
+      with open(self.output, "rb") as f:
+        data = f.read()
+      self.encoder = FitAppender(data, compressed_timestamps=self.compressed_timestamps, fields=fields)
+      if self.checksum is not None:
+        self.checksum = read_fit_checksum(data, "weight_scale")
+      return
+    # the file header, file_id and file_creator messages are only encoded once per process
+    self.encoder = FitEncoderTemplate.get(compressed_timestamps=self.compressed_timestamps, fields=fields).encoder()
+
+  def write(self, entry) -> None:
+    if isinstance(self.encoder, FitAppender) and self.encoder.last_timestamp is not None and \
+        self.encoder.timestamp(entry.time) <= self.encoder.last_timestamp:
+      self.skipped += 1
+      return
+    values = {fit_field: getattr(entry, field) for field, fit_field in self.fit_fields}
+    self.encoder.write_weight_scale(timestamp=entry.time, **values)
+    if self.checksum is not None:
+      values["timestamp"] = int(self.encoder.timestamp(entry.time))
+      self.checksum.add(values)
+    if self.heart_rate and entry.heart_rate:
+      self.encoder.write_blood_pressure(timestamp=entry.time, heart_rate=entry.heart_rate,
+                                        fields=("timestamp", "heart_rate"))
+    self.count += 1
+
+  def close(self) -> None:
+    self.encoder.finish()
+    if isinstance(self.encoder, FitAppender):
+      self.size = self.encoder.get_size()
+      self.replace_output()
+      return
+    data = self.encoder.getvalue()
+    self.size = len(data)
+    f = self.open_output("wb")
+    try:
+      f.write(data)
+    except BaseException:
+      self.discard_output(f)
+      raise
+    self.close_output(f)
+
+  def replace_output(self) -> None:
+    """
+    Write the existing data with the new header and records to a temporary file
+    that atomically replaces the output, so a failed write leaves the old file intact
+    """
+    directory = os.path.dirname(os.path.abspath(self.output))
+    with open(self.output, "rb") as old:
+      old.seek(self.encoder.header_size)
+      data = old.read(self.encoder.existing_size - self.encoder.header_size)
+      mode = stat.S_IMODE(os.fstat(old.fileno()).st_mode)
+    with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as f:
+      try:
+        f.write(self.encoder.header)
+        f.write(data)
+        f.write(self.encoder.getvalue())
+      except BaseException:
+        f.close()
+        os.unlink(f.name)
+        raise
+    os.chmod(f.name, mode)
+    os.replace(f.name, self.output)
+
+  def verify(self) -> int:
+    """
+    Decode the written file and compare its weight_scale records with the entries that were written,
+    raises FitError if the file is invalid or does not match
+
+    Files are read back from disk, for file objects the encoded data is decoded
+
+    :return: number of weight_scale records in the file
+    """
+    if isinstance(self.output, str):
+      with open(self.output, "rb") as f:
+        data = f.read()
+    else:
+      data = self.encoder.getvalue()
+    checksum = read_fit_checksum(data, "weight_scale")
+    if checksum.records != self.checksum.records:
+      raise FitError(f"File has {checksum.records} weight_scale records, expected {self.checksum.records}")
+    if checksum != self.checksum:
+      raise FitError("Checksum of weight_scale values does not match the written entries")
+    return checksum.records
+
+
+class CsvSink(Sink):
+  """
+  Write entries to a csv file with one column per selected field
+  """
+
+  def __init__(self, output: Union[str, IO[str]], fields: list[str] = None):
+    super().__init__(output, fields)
+    self.file = None
+    self.writer = None
+
+  def open(self) -> None:
+    if self.fields is None:
+      self.fields = [x.name for x in dataclasses.fields(WeightEntry)]
+    self.file = self.open_output("w", encoding="utf-8", newline="")
+    self.writer = csv.writer(self.file)
+    self.writer.writerow(self.fields)
+
+  def write(self, entry) -> None:
+    self.writer.writerow(entry_values(entry, self.fields).values())
+    self.count += 1
+
+  def close(self) -> None:
+    self.close_output(self.file)
+
+  def abort(self) -> None:
+    if self.file is not None:
+      self.discard_output(self.file)
+
+
+class JsonlSink(Sink):
+  """
+  Write entries as json objects, one per line
+  """
+
+  def __init__(self, output: Union[str, IO[str]], fields: list[str] = None):
+    super().__init__(output, fields)
+    self.file = None
+
+  def open(self) -> None:
+    self.file = self.open_output("w", encoding="utf-8")
+
+  def write(self, entry) -> None:
+    self.file.write(json.dumps(entry_values(entry, self.fields)))
+    self.file.write("\n")
+    self.count += 1
+
+  def close(self) -> None:
+    self.close_output(self.file)
+
+  def abort(self) -> None:
+    if self.file is not None:
+      self.discard_output(self.file)
+
+
+SINK_TYPES = {
+  ".fit": FitSink,
+  ".csv": CsvSink,
+  ".jsonl": JsonlSink,
+}
+
+
+def entry_values(entry, fields: list[str] = None) -> dict:
+  """
+  Get the values of an entry for text based sinks
+
+  :param entry: WeightEntry to convert
+  :param fields: list of fields to include, None for all fields
+  :return: dict mapping field names to values, times are formatted as strings
+  """
+  if fields is None:
+    fields = [x.name for x in dataclasses.fields(entry)]
+  values = {}
+  for field in fields:
+    value = getattr(entry, field)
+    if field == "time":
+      value = value.strftime(TIME_FORMAT)
+    values[field] = value
+  return values
+
+
+def create_sink(filename: str, fields: list[str] = None) -> Sink:
+  """
+  Create a sink for a file based on its extension
+
+  :param filename: name of file to write
+  :param fields: list of WeightEntry fields to write, None for the sink default
+  :return: Sink for the file
+  """
+  extension = os.path.splitext(filename)[1].lower()
+  if extension not in SINK_TYPES:
+    raise ValueError(f"Unsupported output format {extension or filename}")
+  return SINK_TYPES[extension](filename, fields)
+
+
+def write_sinks(entries: Iterable, sinks: list[Sink]) -> None:
+  """
+  Write entries to several sinks in a single pass, when writing fails every
+  sink that was opened and not closed is aborted
+
+  :param entries: iterable of WeightEntry objects
+  :param sinks: list of sinks to write to
+  :return: None
+  """
+  opened = []
+  try:
+    for sink in sinks:
+      sink.open()
+      opened.append(sink)
+    for entry in entries:
+      for sink in sinks:
+        sink.write(entry)
+    while opened:
+      opened[0].close()
+      opened.pop(0)
+  except BaseException:
+    abort_sinks(opened)
+    raise
+
+
+def abort_sinks(sinks: list[Sink]) -> None:
+  """
+  Abort sinks after an error, errors while aborting are ignored so that every sink is aborted
+
+  :param sinks: list of sinks to abort
+  :return: None
+  """
+  for sink in sinks:
+    try:
+      sink.abort()
+    except Exception:
+      pass
@@ -0,0 +1,81 @@
+import heapq
+import pickle
+import tempfile
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+# approximate memory used by one WeightEntry, used to turn a memory budget into a number of entries
+ENTRY_SIZE_ESTIMATE = 1024
+DEFAULT_MEMORY_BUDGET = 256  # MB
+
+
+def time_key(entry):
+  return entry.time
+
+
+def sort_entries(entries: Iterable, memory_budget: float = DEFAULT_MEMORY_BUDGET,
+                 key: Callable = time_key, tmpdir: str = None) -> Iterator:
+  """
+  Sort entries by time, entries that do not fit in the memory budget are
+  sorted in runs that are spilled to temporary files and merged
+
+  :param entries: iterable of WeightEntry objects
+  :param memory_budget: memory in MB that may be used to hold entries
+  :param key: sort key, time of the entry by default
+  :param tmpdir: directory for temporary run files, None for the system default
+  :return: iterator over entries in sorted order
+  """
+  run_size = max(1, int(memory_budget * 1024 * 1024 // ENTRY_SIZE_ESTIMATE))
+  entries = iter(entries)
+  run = list(islice(entries, run_size))
+  run.sort(key=key)
+  next_run = list(islice(entries, run_size))
+  if not next_run:
+    return iter(run)
+  return _merge_runs(run, next_run, entries, run_size, key, tmpdir)
+
+
+def _merge_runs(run: list, next_run: list, entries: Iterator, run_size: int,
+                key: Callable, tmpdir: str) -> Iterator:
+  """
+  Spill sorted runs to temporary files and merge them
+
+  :param run: first sorted run
+  :param next_run: second, unsorted run
+  :param entries: iterator over the remaining entries
+  :param run_size: number of entries in a run
+  :param key: sort key
+  :param tmpdir: directory for temporary run files
+  :return: iterator over entries in sorted order
+  """
+  run_files = []
+  try:
+    while run:
+      run_file = tempfile.TemporaryFile(dir=tmpdir)
+      run_files.append(run_file)
+      pickler = pickle.Pickler(run_file, protocol=pickle.HIGHEST_PROTOCOL)
+      for entry in run:
+        pickler.dump(entry)
+      run_file.seek(0)
+      run = next_run
+      run.sort(key=key)
+      next_run = list(islice(entries, run_size)) if run else []
+    yield from heapq.merge(*[_read_run(x) for x in run_files], key=key)
+  finally:
+    for run_file in run_files:
+      run_file.close()
+
+
+def _read_run(run_file) -> Iterator:
+  """
+  Read the entries of a run file
+
+  :param run_file: file object positioned at the start of the run
+  :return: iterator over entries in the run
+  """
+  unpickler = pickle.Unpickler(run_file)
+  while True:
+    try:
+      yield unpickler.load()
+    except EOFError:
+      return
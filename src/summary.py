@@ -0,0 +1,132 @@
+import datetime
+import math
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from filters import PERIODS, period_key
+
+SECONDS_PER_WEEK = 7 * 24 * 3600
+
+
+@dataclass
+class PeriodStats:
+  """
+  Running weight and body fat statistics of one family member in one period
+  """
+  count: int = 0
+  weight_count: int = 0
+  weight_min: float = math.inf
+  weight_max: float = -math.inf
+  weight_sum: float = 0.0
+  body_fat_count: int = 0
+  body_fat_sum: float = 0.0
+
+  def add(self, entry) -> None:
+    self.count += 1
+    if entry.weight:
+      self.weight_count += 1
+      self.weight_sum += entry.weight
+      self.weight_min = min(self.weight_min, entry.weight)
+      self.weight_max = max(self.weight_max, entry.weight)
+    if entry.body_fat:
+      self.body_fat_count += 1
+      self.body_fat_sum += entry.body_fat
+
+  @property
+  def weight_mean(self) -> float | None:
+    return self.weight_sum / self.weight_count if self.weight_count else None
+
+  @property
+  def body_fat_mean(self) -> float | None:
+    return self.body_fat_sum / self.body_fat_count if self.body_fat_count else None
+
+
+@dataclass
+class Trend:
+  """
+  Least squares fit of a value against time, updated one reading at a time
+  """
+  origin: datetime.datetime = None
+  n: int = 0
+  sx: float = 0.0
+  sy: float = 0.0
+  sxx: float = 0.0
+  sxy: float = 0.0
+
+  def add(self, time: datetime.datetime, value: float) -> None:
+    if self.origin is None:
+      self.origin = time
+    x = (time - self.origin).total_seconds() / SECONDS_PER_WEEK
+    self.n += 1
+    self.sx += x
+    self.sy += value
+    self.sxx += x * x
+    self.sxy += x * value
+
+  @property
+  def slope(self) -> float | None:
+    """
+    Change of the value per week, None with fewer than two readings at different times
+    """
+    denominator = self.n * self.sxx - self.sx * self.sx
+    if self.n < 2 or abs(denominator) < 1e-12:
+      return None
+    return (self.n * self.sxy - self.sx * self.sy) / denominator
+
+
+@dataclass
+class Summary:
+  """
+  Per period statistics of an export, computed in a single pass over entries in any order
+  """
+  period: str = "week"
+  rows: int = 0
+  groups: dict[tuple, PeriodStats] = field(default_factory=dict)  # (member, period key) -> stats
+  members: dict[str, int] = field(default_factory=dict)  # member -> number of readings
+  body_fat_trends: dict[str, Trend] = field(default_factory=dict)  # member -> body fat trend
+  first: datetime.datetime = None
+  last: datetime.datetime = None
+
+  def __post_init__(self):
+    if self.period not in PERIODS:
+      raise ValueError(f"Unknown period {self.period}")
+
+  def add(self, entry) -> None:
+    self.rows += 1
+    member = entry.family_member
+    self.members[member] = self.members.get(member, 0) + 1
+    key = (member, period_key(entry.time, self.period))
+    stats = self.groups.get(key)
+    if stats is None:
+      stats = self.groups[key] = PeriodStats()
+    stats.add(entry)
+    if entry.body_fat:
+      self.body_fat_trends.setdefault(member, Trend()).add(entry.time, entry.body_fat)
+    if self.first is None or entry.time < self.first:
+      self.first = entry.time
+    if self.last is None or entry.time > self.last:
+      self.last = entry.time
+
+  def update(self, entries: Iterable) -> "Summary":
+    for entry in entries:
+      self.add(entry)
+    return self
+
+  def sorted_groups(self) -> list[tuple[str, tuple, PeriodStats]]:
+    """
+    :return: list of (member, period key, stats) tuples sorted by member and period
+    """
+    return [(member, key, self.groups[(member, key)]) for member, key in sorted(self.groups)]
+
+
+def period_label(key: tuple, period: str) -> str:
+  """
+  Text for a period key
+
+  :param key: key returned by filters.period_key
+  :param period: day or week
+  :return: YYYY-MM-DD for days, YYYY-Www for ISO weeks
+  """
+  if period == "day":
+    return "%04d-%02d-%02d" % key
+  return "%04d-W%02d" % key
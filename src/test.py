@@ -1,6 +1,28 @@
+import bz2
+import csv
 import datetime
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
 import unittest
+import zipfile
 import convert_eufy
+import eufyformatter
+import filters
+import fit
+import metrics
+import pipeline
+import profiles
+import quarantine
+import scanner
+import sharding
+import sinks
+import sorting
+import summary
 
 
 class TestConvertEufy(unittest.TestCase):
@@ -280,6 +302,715 @@ class TestConvertEufy(unittest.TestCase):
         self.assertEqual(output[0], entries[0])
         self.assertEqual(output[1], entries[1])
 
+    def test_csv_read_profile(self):
+        """
+        Test reading a csv file using a user supplied source profile
+        """
+        fname = "./test_data/test_read_profile.csv"
+        profile = profiles.load_profile("./test_data/test_profile.json")
+        profiles.register_profile(profile)
+        try:
+            output = convert_eufy.read_eufyfile(fname)
+        finally:
+            profiles.unregister_profile(profile)
+        self.assertEqual(len(output), 2)
+        self.assertEqual(output[0].time, datetime.datetime(2025, 5, 1, 11, 6, 0))
+        self.assertEqual(output[0].weight, round(79.01 * self.lb_to_kg_factor, 1))
+        self.assertEqual(output[0].body_fat, 26.3)
+        self.assertEqual(output[1].time, datetime.datetime(2025, 4, 29, 5, 38, 0))
+        self.assertEqual(output[1].bmi, 0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "profile.json")
+            for columns in ({"Date": {"field": "time"}, "Weight": {"field": "wieght"}},
+                            {"Date": {"field": "time"}, "Weight": {"unit": "kg"}},
+                            {"Date": {"field": "time"}, "Weight": {"field": "weight", "unit": "stone"}}):
+                with open(fname, "w", encoding="utf-8") as f:
+                    json.dump({"columns": columns}, f)
+                with self.assertRaisesRegex(ValueError, "column Weight|Column Weight"):
+                    profiles.load_profile(fname)
+
+    def test_profile_detection(self):
+        """
+        Test that profiles are selected from the header and decoders are cached
+        """
+        header = ["Time", "WEIGHT (kg)", "BMI"]
+        decoder = profiles.get_decoder(header)
+        self.assertEqual(decoder.profile.name, "eufy")
+        self.assertIs(profiles.get_decoder(list(header)), decoder)
+        self.assertIsNone(profiles.get_decoder(["Time", "Unknown column"]))
+        # known columns without a time column are not a recognized header
+        self.assertIsNone(profiles.get_decoder(["WEIGHT (kg)", "BMI"]))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "no_time.csv")
+            with open(fname, "w", encoding="utf-8") as f:
+                f.write("WEIGHT (kg),BMI\n93.35,17.8\n")
+            with self.assertRaisesRegex(SystemExit, "Unrecognized header"):
+                convert_eufy.read_eufyfile(fname)
+
+    def test_csv_read_sharded(self):
+        """
+        Test that parsing a file in parallel shards gives the same entries as a sequential read
+        """
+        with open("./test_data/test_read_metric.csv", "r", encoding="utf-8-sig") as f:
+            lines = f.read().splitlines()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "large.csv")
+            with open(fname, "w", encoding="utf-8-sig") as f:
+                f.write(lines[0] + "\n")
+                for i in range(200):
+                    f.write(lines[1 + i % 2] + "\n")
+            min_shard_size = sharding.MIN_SHARD_SIZE
+            sharding.MIN_SHARD_SIZE = 1024
+            try:
+                self.assertGreater(len(sharding.shard_ranges(fname, sharding.read_header(fname)[1], 4)), 1)
+                output = convert_eufy.read_eufyfile(fname, workers=4)
+            finally:
+                sharding.MIN_SHARD_SIZE = min_shard_size
+            self.assertEqual(output, convert_eufy.read_eufyfile(fname))
+            self.assertEqual(len(output), 200)
+
+            # rejected rows keep their line number in the file when they are parsed in later shards
+            bad_lines = [2, 40, 41, 99, 150, 201]
+            with open(fname, "w", encoding="utf-8-sig") as f:
+                f.write(lines[0] + "\n")
+                for line in range(2, 202):
+                    row = lines[1 + line % 2]
+                    f.write(row.replace(",93.35,", ",abc,").replace(",33.2,", ",abc,") if line in bad_lines else row)
+                    f.write("\n\n" if line == 120 else "\n")
+            rejected_lines = []
+            sharding.MIN_SHARD_SIZE = 1024
+            try:
+                ranges = sharding.shard_ranges(fname, sharding.read_header(fname)[1], 4)
+                for workers in (1, 4):
+                    rejected = quarantine.Quarantine(os.path.join(tmpdir, f"rejected{workers}.csv"))
+                    output = convert_eufy.read_eufyfile(fname, workers=workers, on_error="skip", quarantine=rejected)
+                    rejected.close()
+                    with open(rejected.filename, encoding="utf-8") as f:
+                        rejected_lines.append([int(row[0]) for row in list(csv.reader(f))[1:]])
+                    self.assertEqual(len(output), 200 - len(bad_lines))
+            finally:
+                sharding.MIN_SHARD_SIZE = min_shard_size
+            self.assertEqual(len(ranges), 4)
+            expected = [x if x <= 120 else x + 1 for x in bad_lines]
+            self.assertEqual(rejected_lines, [expected, expected])
+
+    def test_outlier_filter(self):
+        """
+        Test that readings far from the rolling median of a family member are dropped or flagged
+        """
+        start = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        weights = [80.0, 80.4, 79.8, 80.2, 25.0, 80.1, 140.0, 79.9]
+        entries = [convert_eufy.WeightEntry(time=start + datetime.timedelta(days=i), weight=w,
+                                            family_member="adult")
+                   for i, w in enumerate(weights)]
+        entries.append(convert_eufy.WeightEntry(time=start, weight=25.0, family_member="child"))
+
+        outlier_filter = filters.OutlierFilter(window=5)
+        output = list(outlier_filter(entries))
+        self.assertEqual([x.weight for x in output], [80.0, 80.4, 79.8, 80.2, 80.1, 79.9, 25.0])
+        self.assertEqual(outlier_filter.dropped, 2)
+
+        outlier_filter = filters.OutlierFilter(window=5, action="flag")
+        output = list(outlier_filter(entries))
+        self.assertEqual(len(output), len(entries))
+        self.assertEqual([x.weight for x in output if x.outlier], [25.0, 140.0])
+        self.assertEqual(outlier_filter.flagged, 2)
+
+        # a lasting step change restarts the window after three consistent readings
+        start = datetime.datetime(2025, 1, 1, 7, 0, 0)
+        weights = [90.0, 90.2, 89.9, 90.1, 80.3, 80.1, 80.2, 80.0, 90.1, 80.4]
+        entries = [convert_eufy.WeightEntry(time=start + datetime.timedelta(days=i), weight=x, family_member="a")
+                   for i, x in enumerate(weights)]
+        outlier_filter = filters.OutlierFilter(window=5)
+        output = list(outlier_filter(entries))
+        self.assertEqual([x.weight for x in output], [90.0, 90.2, 89.9, 90.1, 80.2, 80.0, 80.4])
+        self.assertEqual(outlier_filter.dropped, 3)
+
+    def test_csv_read_family_member(self):
+        """
+        Test that the family member column is read
+        """
+        output = convert_eufy.read_eufyfile("./test_data/test_read_metric.csv")
+        self.assertEqual(output[0].family_member, "test")
+        self.assertEqual(output[1].family_member, "test")
+
+    def test_aggregate_entries(self):
+        """
+        Test reducing readings to one entry per day and family member
+        """
+        day = datetime.datetime(2025, 1, 6, 7, 0, 0)
+        entries = [
+            convert_eufy.WeightEntry(time=day, weight=80.0, body_fat=20.0, family_member="a"),
+            convert_eufy.WeightEntry(time=day, weight=30.0, family_member="b"),
+            convert_eufy.WeightEntry(time=day.replace(hour=12), weight=81.0, body_fat=0, family_member="a"),
+            convert_eufy.WeightEntry(time=day.replace(hour=20), weight=79.0, body_fat=22.0, family_member="a"),
+            convert_eufy.WeightEntry(time=day + datetime.timedelta(days=1), weight=80.5, family_member="a"),
+        ]
+        output = list(filters.aggregate_entries(entries, "last", "day"))
+        self.assertEqual([(x.family_member, x.weight) for x in output], [("b", 30.0), ("a", 79.0), ("a", 80.5)])
+        output = list(filters.aggregate_entries(entries, "min", "day"))
+        self.assertEqual([x.weight for x in output], [30.0, 79.0, 80.5])
+        output = list(filters.aggregate_entries(entries, "mean", "day"))
+        self.assertEqual(output[1].weight, 80.0)
+        self.assertEqual(output[1].body_fat, 21.0)
+        self.assertEqual(output[1].time, day.replace(hour=20))
+        output = list(filters.aggregate_entries(entries, "last", "week"))
+        self.assertEqual([x.weight for x in output], [30.0, 80.5])
+        with self.assertRaises(ValueError):
+            list(filters.aggregate_entries(list(reversed(entries)), "last", "day"))
+
+    def test_summary(self):
+        """
+        Test per period statistics and the body fat trend of each family member
+        """
+        day = datetime.datetime(2025, 1, 6, 7, 0, 0)
+        entries = [convert_eufy.WeightEntry(time=day + datetime.timedelta(days=i), weight=80.0 - i / 7,
+                                            body_fat=20.0 - i / 14, family_member="a") for i in range(14)]
+        entries.append(convert_eufy.WeightEntry(time=day, weight=30.0, family_member="b"))
+        result = summary.Summary("week").update(reversed(entries))
+        self.assertEqual(result.rows, 15)
+        self.assertEqual(result.members, {"a": 14, "b": 1})
+        groups = result.sorted_groups()
+        self.assertEqual([(member, summary.period_label(key, "week")) for member, key, _ in groups],
+                         [("a", "2025-W02"), ("a", "2025-W03"), ("b", "2025-W02")])
+        stats = groups[0][2]
+        self.assertEqual((stats.count, stats.weight_min, stats.weight_max), (7, 80.0 - 6 / 7, 80.0))
+        self.assertAlmostEqual(stats.weight_mean, 80.0 - 3 / 7)
+        self.assertIsNone(groups[2][2].body_fat_mean)
+        self.assertAlmostEqual(result.body_fat_trends["a"].slope, -0.5)
+        self.assertNotIn("b", result.body_fat_trends)
+        self.assertEqual((result.first, result.last), (day, day + datetime.timedelta(days=13)))
+
+    def test_write_sinks(self):
+        """
+        Test writing the same entries to fit, csv and jsonl sinks in one pass
+        """
+        entries = convert_eufy.read_eufyfile("./test_data/test_read_metric.csv")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fit_sink = sinks.create_sink(os.path.join(tmpdir, "out.fit"))
+            csv_sink = sinks.create_sink(os.path.join(tmpdir, "out.csv"), ["time", "weight"])
+            jsonl_sink = sinks.create_sink(os.path.join(tmpdir, "out.jsonl"), ["weight", "body_fat"])
+            sinks.write_sinks(iter(entries), [fit_sink, csv_sink, jsonl_sink])
+            with open(csv_sink.filename) as f:
+                self.assertEqual(f.read().splitlines(),
+                                 ["time,weight", "2025-01-17 18:47:20,93.35", "2025-01-18 08:54:08,33.2"])
+            with open(jsonl_sink.filename) as f:
+                self.assertEqual(f.readline(), '{"weight": 93.35, "body_fat": 19.5}\n')
+            with open(fit_sink.filename, "rb") as f:
+                self.assertEqual(f.read(12)[8:], b".FIT")
+            self.assertEqual(fit_sink.count, 2)
+
+            # an empty csv has a header, a failed write removes the partial text outputs
+            empty_sink = sinks.create_sink(os.path.join(tmpdir, "empty.csv"), ["time", "weight"])
+            sinks.write_sinks([], [empty_sink])
+            with open(empty_sink.filename) as f:
+                self.assertEqual(f.read(), "time,weight\n")
+
+            def failing():
+                yield entries[0]
+                raise ValueError("failed")
+            partial = [sinks.create_sink(os.path.join(tmpdir, x))
+                       for x in ("partial.fit", "partial.csv", "partial.jsonl")]
+            with self.assertRaises(ValueError):
+                sinks.write_sinks(failing(), partial)
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["empty.csv", "out.csv", "out.fit", "out.jsonl"])
+        with self.assertRaises(ValueError):
+            sinks.create_sink("out.txt")
+        with self.assertRaises(ValueError):
+            sinks.create_sink("out.json")
+
+        class NoWriteSink(sinks.Sink):
+            pass
+        # a sink without write fails when it is created
+        with self.assertRaises(TypeError):
+            NoWriteSink(io.StringIO())
+
+    def test_pipeline(self):
+        """
+        Test running the reader and writer stages on background threads
+        """
+        produced = []
+
+        def produce(n, fail=False):
+            for i in range(n):
+                produced.append(i)
+                yield i
+            if fail:
+                raise ValueError("failed")
+
+        output = pipeline.threaded(produce(1000), batch_size=10, queue_size=2)
+        self.assertEqual(next(output), 0)
+        time.sleep(0.2)
+        # the reader is blocked by the bounded queue
+        self.assertLessEqual(len(produced), 10 * 4)
+        self.assertEqual([0] + list(output), list(range(1000)))
+        with self.assertRaises(ValueError):
+            list(pipeline.threaded(produce(25, fail=True), batch_size=10))
+
+        fname = "./test_data/test_read_metric.csv"
+        entries = convert_eufy.read_eufyfile(fname, pipelined=True)
+        self.assertEqual(entries, convert_eufy.read_eufyfile(fname))
+        with self.assertRaises(SystemExit):
+            convert_eufy.read_eufyfile("./test_data/test_read_errors.csv", pipelined=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            convert_eufy.write_garmin_file(os.path.join(tmpdir, "serial.fit"), entries)
+            convert_eufy.write_garmin_file(os.path.join(tmpdir, "threaded.fit"), iter(entries), pipelined=True)
+            with open(os.path.join(tmpdir, "serial.fit"), "rb") as f, \
+                    open(os.path.join(tmpdir, "threaded.fit"), "rb") as g:
+                self.assertEqual(f.read(), g.read())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            serial = sinks.CsvSink(os.path.join(tmpdir, "serial.csv"))
+            threaded = sinks.CsvSink(os.path.join(tmpdir, "threaded.csv"))
+            sinks.write_sinks(entries, [serial])
+            pipeline.write_sinks_threaded(iter(entries), [threaded], batch_size=1)
+            with open(serial.filename) as f, open(threaded.filename) as g:
+                self.assertEqual(f.read(), g.read())
+            with self.assertRaises(ValueError):
+                pipeline.write_sinks_threaded(produce(5, fail=True), [sinks.CsvSink(os.path.join(tmpdir, "x.csv"))])
+            with self.assertRaises(AttributeError):
+                pipeline.write_sinks_threaded(entries, [sinks.CsvSink(os.path.join(tmpdir, "y.csv"), ["unknown"])])
+            self.assertEqual(sorted(os.listdir(tmpdir)), ["serial.csv", "threaded.csv"])
+
+    def test_metrics(self):
+        """
+        Test counters, exclusive stage durations and the metrics file formats
+        """
+        run = metrics.Metrics()
+
+        def slow(n):
+            for i in range(n):
+                time.sleep(0.01)
+                yield i
+
+        with run.stage("write"):
+            for _ in run.timed(slow(5), "read"):
+                pass
+        self.assertGreaterEqual(run.durations["read"], 0.05)
+        self.assertLess(run.durations["write"], run.durations["read"])
+        run.count("rows_read", 5)
+        run.count("rows_read")
+        self.assertEqual(run.counters, {"rows_read": 6})
+
+        lines = run.to_prometheus().splitlines()
+        self.assertIn("eufyformatter_rows_read 6", lines)
+        self.assertIn('eufyformatter_stage_seconds{stage="read"} %s' % round(run.durations["read"], 6), lines)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "metrics.json")
+            run.write(fname)
+            with open(fname) as f:
+                values = json.load(f)
+        self.assertEqual(values["rows_read"], 6)
+        self.assertEqual(set(values["stage_seconds"]), {"read", "write"})
+
+        metrics.METRICS.reset()
+        list(convert_eufy.filter_dates(convert_eufy.iter_eufyfile("./test_data/test_read_metric.csv"),
+                                       datetime.datetime(2025, 1, 18), datetime.datetime.max))
+        self.assertEqual(metrics.METRICS.counters, {"rows_read": 2, "rows_filtered": 1})
+
+        # failed runs write the metrics file with their exit code
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "metrics.json")
+            output = os.path.join(tmpdir, "out.fit")
+            args = ["--filename", "./test_data/test_read_errors.csv", "--output", output, "--metrics", fname]
+            with self.assertRaises(SystemExit):
+                convert_eufy.batch_export.main(args, standalone_mode=False)
+            with open(fname) as f:
+                values = json.load(f)
+            self.assertEqual((values["exit_code"], values["success"]), (1, 0))
+            self.assertNotIn("records_encoded", values)
+
+            args = ["--filename", "./test_data/test_read_metric.csv", "--output", output, "--metrics", fname]
+            convert_eufy.batch_export.main(args, standalone_mode=False)
+            convert_eufy.batch_export.main(args + ["--append"], standalone_mode=False)
+            with open(fname) as f:
+                values = json.load(f)
+            self.assertEqual((values["exit_code"], values["success"]), (0, 1))
+            self.assertEqual(values["fit_messages_encoded"], 0)
+
+    def test_fit_compressed_timestamps(self):
+        """
+        Test that records close together in time use compressed timestamp headers
+        """
+        start = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        times = [start + datetime.timedelta(seconds=5 * i) for i in range(30)]
+        times.append(start + datetime.timedelta(hours=1))
+        sizes = []
+        for compressed in (False, True):
+            encoder = fit.FitEncoderWeight(compressed_timestamps=compressed)
+            for t in times:
+                encoder.write_weight_scale(timestamp=t, weight=80.0)
+            encoder.finish()
+            sizes.append(len(encoder.getvalue()))
+        # 29 records without the 4 byte timestamp, one extra definition with 12 fields
+        self.assertEqual(sizes[0] - sizes[1], 29 * 4 - (6 + 12 * 3))
+        data = encoder.getvalue()
+        record_size = 1 + 4 + 2 * 9 + 1 * 3
+        offset = 12 + 6 + 13 * 3 + record_size + 6 + 12 * 3
+        fit_time = int(encoder.timestamp(times[1]))
+        # the compressed definition uses the second local message type
+        self.assertEqual(data[offset], 0x80 | (1 << 5) | (fit_time & 0x1F))
+
+    def test_fit_sparse_definitions(self):
+        """
+        Test that only selected weight_scale fields are defined and that field sets are cached
+        """
+        encoder = fit.FitEncoderWeight(fields=["weight", "percent_fat"])
+        t = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        encoder.write_weight_scale(timestamp=t, weight=80.0, percent_fat=20.0, bmi=25.0)
+        encoder.write_weight_scale(timestamp=t, weight=81.0, percent_fat=21.0)
+        encoder.write_weight_scale(timestamp=t, weight=81.0, fields=["weight"])
+        encoder.write_weight_scale(timestamp=t, weight=80.5, percent_fat=20.5)
+        data = encoder.getvalue()
+        # two definitions, each followed by their records
+        definition = 1 + 5 + 3 * 3
+        record = 1 + 4 + 2 + 2
+        self.assertEqual(len(data), 12 + definition + 2 * record + (1 + 5 + 2 * 3) + (1 + 4 + 2) + record)
+        self.assertEqual(len(encoder.local_types), 2)
+        self.assertEqual(data[12 + definition + 2 * record], 0x40 | 1)
+        self.assertEqual(data[-record], 0)
+
+    def test_fit_sink_fields(self):
+        """
+        Test that fit sinks only define the selected fields
+        """
+        entries = convert_eufy.read_eufyfile("./test_data/test_read_metric.csv")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fit_sink = sinks.FitSink(os.path.join(tmpdir, "out.fit"), ["time", "weight", "body_fat", "family_member"])
+            sinks.write_sinks(entries, [fit_sink])
+            with open(fit_sink.filename, "rb") as f:
+                data = f.read()
+        self.assertEqual(fit_sink.fit_fields, [("weight", "weight"), ("body_fat", "percent_fat")])
+        file_id = (1 + 5 + 6 * 3) + (1 + 4 + 4 + 2 * 3 + 1)
+        file_creator = (1 + 5 + 2 * 3) + (1 + 2 + 1)
+        weight_scale = (1 + 5 + 3 * 3) + 2 * (1 + 4 + 2 + 2)
+        self.assertEqual(len(data), 12 + file_id + file_creator + weight_scale + 2)
+
+    def test_fit_message_registry(self):
+        """
+        Test that messages are packed from their schema and heart rate is written as blood_pressure
+        """
+        compiled = fit.MESSAGE_SCHEMAS["blood_pressure"].compile(("timestamp", "heart_rate"))
+        self.assertIs(fit.MESSAGE_SCHEMAS["blood_pressure"].compile(["timestamp", "heart_rate"]), compiled)
+        self.assertEqual(compiled.pack({"timestamp": 1000, "heart_rate": 61.0}), b"\xe8\x03\x00\x00\x3d")
+        self.assertEqual(compiled.pack({"timestamp": 1000}), b"\xe8\x03\x00\x00\xff")
+        self.assertEqual(fit.field_limits("blood_pressure", "heart_rate"), (0, 254))
+        self.assertEqual(fit.field_limits("weight_scale", "weight"), (0, 655.34))
+        with self.assertRaises(fit.FitError):
+            compiled.pack({"timestamp": 1000, "heart_rate": 300})
+        with self.assertRaises(ValueError):
+            fit.MESSAGE_SCHEMAS["weight_scale"].compile(("timestamp", "heart_rate"))
+
+        entries = convert_eufy.read_eufyfile("./test_data/test_read_metric.csv")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fit_sink = sinks.FitSink(os.path.join(tmpdir, "out.fit"), ["time", "weight", "heart_rate"])
+            sinks.write_sinks(entries, [fit_sink])
+            with open(fit_sink.filename, "rb") as f:
+                data = f.read()
+        bp_definition = b"\x00\x00\x33\x00\x02\xfd\x04\x86\x06\x01\x02"
+        self.assertEqual(data.count(bp_definition), 1)
+        self.assertEqual(len(fit_sink.encoder.local_types), 4)
+
+        with self.assertRaises(ValueError):
+            fit.FitMessageSchema("hrv", [("time", 0, fit.FitBaseType.uint16, 1000)])
+        fit.register_message(fit.FitMessageSchema("hrv", [("time", 0, fit.FitBaseType.uint16, 1000)], 78))
+        try:
+            encoder = fit.FitEncoder()
+            encoder.write_message("hrv", time=0.85)
+            encoder.write_message("hrv", time=0.9)
+            encoder.finish()
+            checksum = fit.FitChecksum("hrv")
+            checksum.add({"time": 0.85})
+            checksum.add({"time": 0.9})
+            self.assertEqual(fit.read_fit_checksum(encoder.getvalue(), "hrv"), checksum)
+            self.assertIn(b"\x00\x00\x4e\x00\x01\x00\x02\x84", encoder.getvalue())
+        finally:
+            del fit.MESSAGE_SCHEMAS["hrv"]
+            del fit.Fit.GMSG_NUMS["hrv"]
+
+    def test_fit_verify(self):
+        """
+        Test decoding written fit files and detecting corrupted files
+        """
+        data = bytes(range(256)) * 3
+        crc = 0
+        for byte in data:
+            crc = fit._calcCRC(crc, byte)
+        self.assertEqual(fit.crc16(data), crc)
+
+        start = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        entries = [convert_eufy.WeightEntry(time=start + datetime.timedelta(seconds=7 * i),
+                                            weight=80 + i / 10, body_fat=20.0, heart_rate=60)
+                   for i in range(40)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fit_sink = sinks.FitSink(os.path.join(tmpdir, "out.fit"), ["time", "weight", "body_fat", "heart_rate"],
+                                     compressed_timestamps=True, verify=True)
+            sinks.write_sinks(entries, [fit_sink])
+            self.assertEqual(fit_sink.verify(), 40)
+
+            with open(fit_sink.filename, "rb") as f:
+                data = bytearray(f.read())
+            data[-10] ^= 0xFF
+            with open(fit_sink.filename, "wb") as f:
+                f.write(data)
+            with self.assertRaises(fit.FitError):
+                fit_sink.verify()
+
+            fit_sink.checksum.records += 1
+            with open(fit_sink.filename, "wb") as f:
+                f.write(fit_sink.encoder.getvalue())
+            with self.assertRaises(fit.FitError):
+                fit_sink.verify()
+
+    def test_fit_append(self):
+        """
+        Test appending records to an existing fit file, reusing its definitions and updating the crc
+        """
+        data = bytes(range(256)) * 3
+        self.assertEqual(fit.crc16(data, 0x1234) ^ fit.crc16(data, 0xBEEF),
+                         fit.crc16_shift(0x1234 ^ 0xBEEF, len(data)))
+
+        start = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        entries = [convert_eufy.WeightEntry(time=start + datetime.timedelta(seconds=7 * i),
+                                            weight=80 + i / 10, body_fat=20.0, heart_rate=60)
+                   for i in range(40)]
+        fields = ["time", "weight", "body_fat", "heart_rate"]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "out.fit")
+            sinks.write_sinks(entries[:25], [sinks.FitSink(fname, fields, compressed_timestamps=True)])
+            fit_sink = sinks.FitSink(fname, fields, compressed_timestamps=True, verify=True, append=True)
+            sinks.write_sinks(entries, [fit_sink])
+            self.assertEqual((fit_sink.count, fit_sink.skipped), (15, 25))
+            self.assertEqual(fit_sink.verify(), 40)
+            # the first new record uses a compressed header with an existing definition
+            self.assertEqual(fit_sink.encoder.getvalue()[0] & 0xE0, 0x80 | (fit_sink.encoder.local_types[
+                fit.MESSAGE_SCHEMAS['weight_scale'].compile(('weight', 'percent_fat'))] << 5))
+
+            # a failed write leaves the existing file unchanged
+            with open(fname, "rb") as f:
+                before = f.read()
+            failing_sink = sinks.FitSink(fname, fields, append=True)
+            failing_sink.open()
+            failing_sink.write(convert_eufy.WeightEntry(time=start + datetime.timedelta(days=1), weight=80.0))
+
+            def fail():
+                raise OSError("No space left on device")
+            failing_sink.encoder.getvalue = fail
+            with self.assertRaises(OSError):
+                failing_sink.close()
+            with open(fname, "rb") as f:
+                self.assertEqual(f.read(), before)
+            self.assertEqual(os.listdir(tmpdir), ["out.fit"])
+
+            full_sink = sinks.FitSink(os.path.join(tmpdir, "full.fit"), fields, compressed_timestamps=True)
+            sinks.write_sinks(entries, [full_sink])
+            with open(fname, "rb") as f:
+                appended = f.read()
+            self.assertEqual(fit.read_fit_checksum(appended),
+                             fit.read_fit_checksum(full_sink.encoder.getvalue()))
+
+            with open(fname, "wb") as f:
+                f.write(appended[:-1] + bytes([appended[-1] ^ 0xFF]))
+            with self.assertRaises(fit.FitError):
+                sinks.write_sinks(entries, [sinks.FitSink(fname, fields, append=True)])
+
+    def test_fit_template(self):
+        """
+        Test that encoders started from a cached template write the same bytes as a new encoder
+        """
+        created = datetime.datetime(2025, 1, 1, 7, 0, 0)
+        start = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        for fields in (None, ['weight', 'percent_fat']):
+            template = fit.FitEncoderTemplate.get(compressed_timestamps=True, fields=fields)
+            self.assertIs(template, fit.FitEncoderTemplate.get(compressed_timestamps=True, fields=fields))
+            for _ in range(2):
+                encoder = fit.FitEncoderWeight(compressed_timestamps=True, fields=fields)
+                encoder.write_file_info(time_created=created)
+                encoder.write_file_creator()
+                encoders = [encoder, template.encoder(time_created=created)]
+                for encoder in encoders:
+                    for i in range(5):
+                        encoder.write_weight_scale(start + datetime.timedelta(seconds=10 * i),
+                                                   weight=80 + i / 10, percent_fat=20.0)
+                    encoder.write_blood_pressure(start, heart_rate=60)
+                    encoder.finish()
+                self.assertEqual(encoders[0].getvalue(), encoders[1].getvalue())
+
+    def test_csv_read_compressed(self):
+        """
+        Test reading gzip, bz2 and zip compressed exports and stdin
+        """
+        fname = "./test_data/test_read_imperial.csv"
+        expected = convert_eufy.read_eufyfile(fname)
+        with open(fname, "rb") as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            names = [os.path.join(tmpdir, "export.csv.gz"), os.path.join(tmpdir, "export.csv.bz2"),
+                     os.path.join(tmpdir, "export.zip")]
+            with gzip.open(names[0], "wb") as f:
+                f.write(data)
+            with bz2.open(names[1], "wb") as f:
+                f.write(data)
+            with zipfile.ZipFile(names[2], "w") as archive:
+                archive.writestr("readme.txt", "not a csv file")
+                archive.writestr("export/weights.csv", data)
+            for name in names:
+                self.assertEqual(convert_eufy.read_eufyfile(name, workers=2), expected)
+            stats = eufyformatter.convert(names[2], io.BytesIO())
+            self.assertEqual(stats.records_written, len(expected))
+
+            with zipfile.ZipFile(names[2], "w") as archive:
+                archive.writestr("readme.txt", "not a csv file")
+            with self.assertRaises(eufyformatter.SourceError):
+                list(eufyformatter.iter_source_entries(names[2]))
+            with open(names[0], "wb") as f:
+                f.write(b"not gzip data")
+            with self.assertRaises(eufyformatter.SourceError):
+                list(eufyformatter.iter_source_entries(names[0]))
+
+        stdin = sys.stdin
+        sys.stdin = io.TextIOWrapper(io.BytesIO(data))
+        try:
+            self.assertEqual(convert_eufy.read_eufyfile("-"), expected)
+        finally:
+            sys.stdin = stdin
+
+    def test_scanner(self):
+        """
+        Test splitting csv records at the byte level with quoted fields handled by the csv module
+        """
+        data = (b'\xef\xbb\xbfTime,Name,Weight\r\n2025-01-17 18:47:20,a 5"11,93.35\r\n\r\n'
+                b'2025-01-18 08:54:08,"b, c",93.3\n2025-01-19 08:54:08,"d\n""e""",93.2\n2025-01-20 08:54:08,f,93.1')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "test.csv")
+            with open(fname, "wb") as f:
+                f.write(data)
+            records = list(scanner.scan_file(fname))
+            with open(fname, "r", encoding="utf-8-sig", newline="") as f:
+                reader = csv.reader(f)
+                expected = [(reader.line_num, row) for row in reader if row]
+            self.assertEqual(records, expected)
+            self.assertEqual(records[1], (2, ["2025-01-17 18:47:20", 'a 5"11', "93.35"]))
+            self.assertEqual(records[3], (6, ["2025-01-19 08:54:08", 'd\n"e"', "93.2"]))
+            # lines are split across chunk boundaries
+            small = list(scanner.iter_records(scanner.iter_lines(data, 3)))
+            scanner.CHUNK_SIZE, chunk_size = 7, scanner.CHUNK_SIZE
+            try:
+                self.assertEqual(list(scanner.iter_records(scanner.iter_lines(data, 3))), small)
+            finally:
+                scanner.CHUNK_SIZE = chunk_size
+            with open(fname, "wb") as f:
+                pass
+            self.assertEqual(list(scanner.scan_file(fname)), [])
+
+            # invalid utf-8 is a row error, even when rows are skipped
+            with open("./test_data/test_read_metric.csv", "rb") as f:
+                metric = f.read()
+            with open(fname, "wb") as f:
+                f.write(metric.replace(b"test ,", b'te"st\xff,'))
+            with self.assertRaises(eufyformatter.RowError) as cm:
+                list(eufyformatter.iter_file_entries(fname))
+            self.assertEqual(cm.exception.line, 2)
+            rejected = quarantine.Quarantine()
+            self.assertEqual(len(list(eufyformatter.iter_file_entries(fname, "skip", rejected))), 1)
+            self.assertEqual(rejected.reasons, {"invalid utf-8": 1})
+        fname = "./test_data/test_read_imperial.csv"
+        with open(fname, "r", encoding="utf-8-sig", newline="") as f:
+            self.assertEqual(list(eufyformatter.iter_file_entries(fname)), list(eufyformatter.iter_entries(f)))
+
+    def test_sort_entries(self):
+        """
+        Test sorting entries in memory and with runs spilled to disk
+        """
+        start = datetime.datetime(2025, 1, 1, 8, 0, 0)
+        entries = [convert_eufy.WeightEntry(time=start + datetime.timedelta(hours=(i * 37) % 101), weight=i)
+                   for i in range(101)]
+        expected = sorted(entries, key=lambda x: x.time)
+        self.assertEqual(list(sorting.sort_entries(entries)), expected)
+        # a budget of 10 entries forces 11 runs to be merged
+        budget = 10 * sorting.ENTRY_SIZE_ESTIMATE / (1024 * 1024)
+        output = list(sorting.sort_entries(iter(entries), memory_budget=budget))
+        self.assertEqual(output, expected)
+        self.assertEqual(list(sorting.sort_entries([], memory_budget=budget)), [])
+
+    def test_csv_read_skip_errors(self):
+        """
+        Test skipping rows that cannot be converted and writing them to a quarantine file
+        """
+        fname = "./test_data/test_read_errors.csv"
+        with self.assertRaises(SystemExit):
+            convert_eufy.read_eufyfile(fname)
+        for workers in (1, 2):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                rejected = quarantine.Quarantine(os.path.join(tmpdir, "rejected.csv"))
+                output = convert_eufy.read_eufyfile(fname, workers=workers, on_error="skip", quarantine=rejected)
+                rejected.close()
+                with open(rejected.filename) as f:
+                    lines = f.read().splitlines()
+            self.assertEqual([x.weight for x in output], [93.35, 92.1])
+            self.assertEqual(rejected.count, 2)
+            self.assertEqual(rejected.unknown_columns, ["NOTES"])
+            self.assertEqual(lines, ["line,reason,Time,Family Members,WEIGHT (kg),BMI,NOTES",
+                                     "3,invalid value: column WEIGHT (kg): 'abc',2025-01-18 08:54:08,test,abc,17.9,typo",
+                                     "4,\"missing values: expected 5 values, found 2\",2025-01-19 08:54:08,test"])
+
+    def test_convert_in_memory(self):
+        """
+        Test converting from bytes and streams to an in-memory FIT file without exiting on errors
+        """
+        with open("./test_data/test_read_metric.csv", "rb") as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "test.fit")
+            convert_eufy.write_garmin_file(fname, convert_eufy.read_eufyfile("./test_data/test_read_metric.csv"))
+            with open(fname, "rb") as f:
+                expected = f.read()
+        for source in (data, io.BytesIO(data), io.StringIO(data.decode("utf-8-sig"), newline="")):
+            output = io.BytesIO()
+            stats = eufyformatter.convert(source, output, verify=True)
+            self.assertEqual(output.getvalue()[:12], expected[:12])
+            self.assertEqual(stats.rows_read, 2)
+            self.assertEqual(stats.records_written, 2)
+            self.assertEqual(stats.bytes_written, len(expected))
+        stats = eufyformatter.convert(data, io.BytesIO(), start=datetime.date(2025, 1, 18))
+        self.assertEqual(stats.rows_filtered, 1)
+        self.assertEqual(stats.records_written, 1)
+
+        with open("./test_data/test_read_errors.csv", "rb") as f:
+            errors = f.read()
+        stats = eufyformatter.convert(errors, io.BytesIO(), on_error="skip")
+        self.assertEqual((stats.rows_read, stats.rows_skipped), (2, 2))
+        with self.assertRaises(eufyformatter.SourceError):
+            eufyformatter.convert(errors, io.BytesIO())
+        with self.assertRaises(eufyformatter.RowError) as cm:
+            eufyformatter.convert(data.replace(b"93.35", b"abc"), io.BytesIO())
+        self.assertEqual(cm.exception.line, 2)
+        # decoder and time filter failures are reported as conversion errors
+        for on_error in ("raise", "skip"):
+            with self.assertRaises(eufyformatter.SourceError):
+                eufyformatter.convert(b"WEIGHT (kg),BMI\n93.35,17.8\n", io.BytesIO(), on_error=on_error)
+        aware = datetime.datetime(2025, 1, 18, tzinfo=datetime.timezone.utc)
+        with self.assertRaises(eufyformatter.SourceError):
+            eufyformatter.convert(data, io.BytesIO(), start=aware)
+        # values that do not fit their FIT field are rejected with the row
+        heavy = data.replace(b"93.35", b"800")
+        with self.assertRaisesRegex(eufyformatter.RowError, "out of range.*WEIGHT") as cm:
+            eufyformatter.convert(heavy, io.BytesIO())
+        self.assertEqual(cm.exception.line, 2)
+        stats = eufyformatter.convert(heavy, io.BytesIO(), on_error="skip")
+        self.assertEqual((stats.rows_skipped, stats.records_written), (1, 1))
+        # times with a timezone or without a time of day are invalid values, in both read paths
+        for time in (b"2025-01-17T18:47:20+02:00", b"2025-01-17"):
+            with self.assertRaisesRegex(eufyformatter.RowError, "column Time") as cm:
+                eufyformatter.convert(data.replace(b"2025-01-17 18:47:20", time), io.BytesIO())
+            self.assertEqual(cm.exception.line, 2)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fname = os.path.join(tmpdir, "time.csv")
+                with open(fname, "wb") as f:
+                    f.write(data.replace(b"2025-01-17 18:47:20", time))
+                with self.assertRaises(eufyformatter.RowError):
+                    eufyformatter.read_entries_sharded(fname, 2)
+
 
 if __name__ == '__main__':
     unittest.main()